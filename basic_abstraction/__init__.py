@@ -1,7 +1,23 @@
-from basic_abstraction.base import Abstraction
+from basic_abstraction.base import (
+    Abstraction,
+    ThreadScheduler,
+    PoolScheduler,
+    AsyncioScheduler,
+)
+from basic_abstraction.transport import (
+    UnixTransport,
+    UDPTransport,
+    TCPTransport,
+    SharedMemoryTransport,
+)
+from basic_abstraction.metrics import MetricsRegistry
 from basic_abstraction.link import PerfectLink
-from basic_abstraction.broadcast import BestEffortBroadcast, EagerReliableBroadcast
+from basic_abstraction.broadcast import (
+    BestEffortBroadcast,
+    EagerReliableBroadcast,
+    LazyReliableBroadcast,
+)
 from basic_abstraction.failure_detector import PerfectFailureDetector
-from basic_abstraction.consensus import HierarchicalConsensus
-from basic_abstraction.leader import LeaderElection
+from basic_abstraction.consensus import HierarchicalConsensus, MultiPaxosConsensus
+from basic_abstraction.leader import LeaderElection, LeaseLeaderElection
 from basic_abstraction.voting import MajorityVoting
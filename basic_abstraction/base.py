@@ -1,9 +1,241 @@
-from threading import Thread
+import asyncio
+import inspect
+import time
+import traceback
+from collections import deque
+from threading import Thread, Condition, get_ident
 from queue import Queue, Empty
 
+from basic_abstraction.timer import Timer, TimerService
 from utils import Logging
 
 
+class Scheduler:
+    """This abstract class implements the runtime executing abstractions' events.
+
+    A scheduler decides where and when the events queued by an Abstraction are
+    executed. Whatever the scheduler, an abstraction's events are executed in
+    the order they were triggered and one at a time. The scheduler is notified
+    each time an event is added to an abstraction's queue.
+
+    The scheduler used by newly created abstractions is set process-wide
+    through Abstraction.set_scheduler.
+
+    A scheduler also runs the abstractions' timers. One-shot and periodic
+    callbacks are registered with call_later and call_every, which return a
+    Timer that may be cancelled. By default, every scheduler of the process
+    shares the same TimerService and its single thread.
+
+    """
+
+    # Event loop on which abstractions run, if any (see AsyncioScheduler).
+    loop = None
+
+    timer_service = TimerService()
+
+    def start(self, abstraction):
+        pass
+
+    def stop(self, abstraction):
+        pass
+
+    def notify(self, abstraction):
+        pass
+
+    def call_later(self, delay, callback, *args):
+        return self.timer_service.call_later(delay, callback, *args)
+
+    def call_every(self, period, callback, *args):
+        return self.timer_service.call_every(period, callback, *args)
+
+
+class ThreadScheduler(Scheduler):
+    """This class implements the default scheduler.
+
+    Each abstraction owns a dedicated thread executing its run_tasks method.
+
+    """
+
+    def start(self, abstraction):
+        abstraction.base_worker = Thread(target=abstraction.run_tasks)
+        abstraction.base_worker.start()
+
+    def stop(self, abstraction):
+        # Wake the abstraction's thread up such that it notices it stopped
+        abstraction.event_queue.put(None)
+
+
+class PoolScheduler(Scheduler):
+    """This class implements a worker pool scheduler.
+
+    Abstractions share a bounded pool of worker threads. An abstraction with
+    pending events is queued in a ready queue, and notified workers take turns
+    at executing its events. An abstraction is held by at most one worker at a
+    time such that its events are still executed in order and one at a time.
+
+    Stopping an abstraction takes effect immediately, its pending events, and
+    those triggered afterwards, are discarded (and marked done, such that
+    joining its event queue does not hang). As workers are shared, events
+    should not block for long (a SlowFlightComputer holds a worker while its
+    link sleeps).
+
+    """
+
+    def __init__(self, workers=4, quantum=8):
+        self.quantum = quantum
+        self.condition = Condition()
+        self.ready = deque()
+        self.scheduled = set()
+        self.started = set()
+        self.workers = [Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def start(self, abstraction):
+        with self.condition:
+            self.started.add(abstraction)
+        self.notify(abstraction)
+
+    def stop(self, abstraction):
+        with self.condition:
+            self.started.discard(abstraction)
+        self.discard_events(abstraction)
+
+    def discard_events(self, abstraction):
+        while True:
+            try:
+                abstraction.event_queue.get_nowait()
+            except Empty:
+                return
+            abstraction.event_queue.task_done()
+
+    def notify(self, abstraction):
+        if not abstraction.alive:
+            return self.discard_events(abstraction)
+        with self.condition:
+            if abstraction in self.scheduled or abstraction not in self.started:
+                return
+            self.scheduled.add(abstraction)
+            self.ready.append(abstraction)
+            self.condition.notify()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.ready:
+                    self.condition.wait()
+                abstraction = self.ready.popleft()
+
+            for _ in range(self.quantum):
+                if not abstraction.alive:
+                    break
+                try:
+                    abstraction.run_next_task()
+                except Empty:
+                    break
+                except Exception:
+                    traceback.print_exc()
+
+            with self.condition:
+                if abstraction.alive and not abstraction.event_queue.empty():
+                    self.ready.append(abstraction)
+                else:
+                    self.scheduled.discard(abstraction)
+
+
+class AsyncioScheduler(Scheduler):
+    """This class implements an asyncio scheduler.
+
+    All abstractions of the process share a single event loop running in a
+    dedicated thread. Each abstraction is served by a coroutine that waits to
+    be notified and then executes the pending events, yielding to the other
+    abstractions between two events. Events may be triggered from any thread.
+
+    Since every abstraction shares the same thread, events must not block. An
+    event may however return an awaitable, in which case the abstraction's
+    coroutine awaits it before executing the next event.
+
+    Timers are run by the event loop as well, instead of the timer service.
+
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.wakeups = {}
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def start(self, abstraction):
+        future = asyncio.run_coroutine_threadsafe(
+            self.run_tasks(abstraction), self.loop
+        )
+        future.add_done_callback(self.report)
+
+    def report(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            traceback.print_exception(
+                type(future.exception()),
+                future.exception(),
+                future.exception().__traceback__,
+            )
+
+    def stop(self, abstraction):
+        self.loop.call_soon_threadsafe(self.wake, abstraction)
+
+    def notify(self, abstraction):
+        self.call_soon(self.wake, abstraction)
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(None, callback, args)
+        self.call_soon(self.loop.call_later, delay, self.run_timer, timer)
+        return timer
+
+    def call_every(self, period, callback, *args):
+        timer = Timer(None, callback, args, period)
+        self.call_soon(self.loop.call_later, period, self.run_timer, timer)
+        return timer
+
+    def call_soon(self, callback, *args):
+        if get_ident() == self.thread.ident:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def run_timer(self, timer):
+        if timer.cancelled:
+            return
+        try:
+            timer.fire()
+        except Exception:
+            traceback.print_exc()
+        if timer.period is not None:
+            self.loop.call_later(timer.period, self.run_timer, timer)
+
+    def wake(self, abstraction):
+        wakeup = self.wakeups.get(abstraction)
+        if wakeup is not None:
+            wakeup.set()
+
+    async def run_tasks(self, abstraction):
+        wakeup = asyncio.Event()
+        self.wakeups[abstraction] = wakeup
+        try:
+            while abstraction.alive:
+                wakeup.clear()
+                while abstraction.alive:
+                    try:
+                        result = abstraction.run_next_task()
+                    except Empty:
+                        break
+                    if result is not None and hasattr(result, "__await__"):
+                        await result
+                    else:
+                        await asyncio.sleep(0)
+                await wakeup.wait()
+        finally:
+            del self.wakeups[abstraction]
+
+
 class Abstraction:
     """This class implements an abstracton.
 
@@ -12,37 +244,170 @@ class Abstraction:
     correspond to one of the Abstraction's methods. For instance, a hierchical
     consensus object would have a "propose" method, one would then trigger the
     "propose" event to trigger the consensus. Events are triggered through the
-    method itself or its name (see below.)
+    method itself, its name or its event id (see below.)
+
+    Each Abstraction class registers its methods in an event table when it is
+    defined, giving each of them a small integer id. Events are queued and
+    sent over links by id. The events an abstraction receives from its peers
+    must be listed in EVENTS, in a fixed order: their ids are their position
+    in it, such that peers agree on them even if their classes differ in
+    other methods (e.g. a subclass or another version of the code). A
+    subclass adding such events appends them to its parent's EVENTS. Other
+    methods are local events, numbered after them, and sending them to a
+    peer raises an exception (see Registrable.client_event_id).
+
+    Events listed in UNBATCHED_EVENTS are latency-critical, links never hold
+    them back to batch them with other messages (see ./link.py).
+
+    Abstractions created while a MetricsRegistry is set through set_metrics
+    (see ./metrics.py) report the depth of their event queue and the time
+    spent in each event's handler, labelled with their process number and
+    class. Abstractions created without one measure nothing.
 
     """
 
+    EVENTS = ()
+    UNBATCHED_EVENTS = ()
+
     TIMEOUT = 1
 
+    scheduler = ThreadScheduler()
+
+    metrics = None
+
+    def set_scheduler(scheduler):
+        Abstraction.scheduler = scheduler
+
+    def set_metrics(metrics):
+        Abstraction.metrics = metrics
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.register_events()
+
+    @classmethod
+    def register_events(cls):
+        for name in cls.EVENTS:
+            if not inspect.isfunction(getattr(cls, name, None)):
+                raise Exception(f"{cls.__name__} has no event {name}")
+        cls.event_names = cls.EVENTS + tuple(
+            name
+            for name in sorted(dir(cls))
+            if not name.startswith("_")
+            and name not in cls.EVENTS
+            and inspect.isfunction(getattr(cls, name))
+        )
+        cls.event_ids = {name: i for i, name in enumerate(cls.event_names)}
+        cls.unbatched_ids = frozenset(
+            cls.event_ids[name] for name in cls.UNBATCHED_EVENTS
+        )
+
     def __init__(self):
         self.alive = True
         self.event_queue = Queue()
-        self.base_worker = Thread(target=self.run_tasks)
+        self.scheduler = Abstraction.scheduler
+        self.handlers = [getattr(self, name) for name in self.event_names]
+        self.metrics = Abstraction.metrics
+        self.handler_times = None
 
     def start(self):
-        self.base_worker.start()
+        if self.metrics is not None:
+            self._start_metrics()
+        self.scheduler.start(self)
 
     def stop(self):
         self.alive = False
+        if self.handler_times is not None:
+            for gauge, function in self.gauge_functions:
+                gauge.remove_function(function)
+        self.scheduler.stop(self)
+
+    def _start_metrics(self):
+        # Subclasses only know their process number once initialized
+        self.metric_labels = {
+            "process": getattr(self, "process_number", None),
+            "abstraction": type(self).__name__,
+        }
+        self.gauge_functions = []
+        self._add_gauge_function("queue_depth", self.event_queue.qsize)
+        self.handler_times = [None] * len(self.handlers)
+
+    def _add_gauge_function(self, name, function):
+        """Adds function to a gauge until the abstraction is stopped."""
+        gauge = self.metrics.gauge(name, **self.metric_labels)
+        gauge.add_function(function)
+        self.gauge_functions.append((gauge, function))
+
+    def _handler_time(self, event_id):
+        histogram = self.handler_times[event_id]
+        if histogram is None:
+            event = self.event_names[event_id]
+            histogram = self.handler_times[event_id] = self.metrics.histogram(
+                "handler_seconds", event=event, **self.metric_labels
+            )
+        return histogram
 
     def run_tasks(self):
+        if self.handler_times is not None:
+            return self._run_measured_tasks()
         while self.alive:
+            event = self.event_queue.get()
+            if event is not None and self.alive:
+                event_id, args, kwargs = event
+                self.handlers[event_id](*args, **kwargs)
+            self.event_queue.task_done()
+
+    def _run_measured_tasks(self):
+        while self.alive:
+            event = self.event_queue.get()
+            if event is not None and self.alive:
+                event_id, args, kwargs = event
+                start = time.perf_counter()
+                self.handlers[event_id](*args, **kwargs)
+                self._handler_time(event_id).observe(time.perf_counter() - start)
+            self.event_queue.task_done()
+
+    def run_next_task(self):
+        """Executes the next queued event without blocking.
+
+        Raises Empty if no event is queued. Used by schedulers that do not
+        dedicate a thread to the abstraction.
+
+        """
+        event_id, args, kwargs = self.event_queue.get_nowait()
+        try:
+            if not self.alive:
+                return None
+            if self.handler_times is None:
+                return self.handlers[event_id](*args, **kwargs)
+            # Coroutine handlers are only measured until they first await
+            start = time.perf_counter()
             try:
-                event_name, args, kwargs = self.event_queue.get(timeout=self.TIMEOUT)
-            except Empty:
-                continue
-            else:
-                if self.alive:
-                    getattr(self, event_name)(*args, **kwargs)
-                self.event_queue.task_done()
+                return self.handlers[event_id](*args, **kwargs)
+            finally:
+                self._handler_time(event_id).observe(time.perf_counter() - start)
+        finally:
+            self.event_queue.task_done()
 
     def trigger_event(self, event, args=(), kwargs={}):
+        event_id = self.event_id(event)
+        self.event_queue.put((event_id, args, kwargs))
+        self.scheduler.notify(self)
+
+    def trigger_later(self, delay, event, args=(), kwargs={}):
+        """Triggers an event after delay seconds, returns a cancellable Timer."""
+        return self.scheduler.call_later(
+            delay, self.trigger_event, self.event_id(event), args, kwargs
+        )
+
+    def event_id(self, event):
+        if type(event) is int:
+            return event
         event_name = self.stringify_event(event)
-        self.event_queue.put((event_name, args, kwargs))
+        try:
+            return self.event_ids[event_name]
+        except KeyError:
+            raise Exception(f"{type(self).__name__} has no event {event_name}")
 
     def stringify_event(self, event):
         if isinstance(event, str):
@@ -53,6 +418,9 @@ class Abstraction:
             raise Exception("Events must be strings or have __name__ attr")
 
 
+Abstraction.register_events()
+
+
 class Subscriptable(Abstraction):
     """This class implements a subscriptable abstraction.
 
@@ -79,10 +447,10 @@ class Subscriptable(Abstraction):
         self.callbacks.append(callback)
 
     def subscribe_abstraction(self, abstraction, event):
-        event_name = self.stringify_event(event)
+        event_id = abstraction.event_id(event)
 
         def callback(*args, **kwargs):
-            abstraction.trigger_event(event_name, args=args, kwargs=kwargs)
+            abstraction.trigger_event(event_id, args=args, kwargs=kwargs)
 
         self.subscribe(callback)
 
@@ -110,17 +478,21 @@ class Registrable(Abstraction):
     they would ave the same client id).
 
     One has to implement generate_caller and generate_abstraction_caller for
-    functions and abstraction callbacks respectively.
+    functions and abstraction callbacks respectively. Abstraction callers
+    should forward events by id (see client_event_id), although event names
+    are still accepted by the redirected callbacks.
 
     """
 
     def __init__(self):
         super().__init__()
         self.callbacks = []
+        self.clients = []
         self.callback_id = 0
 
-    def _register(self, callback):
+    def _register(self, callback, client=None):
         self.callbacks.append(callback)
+        self.clients.append(client)
         self.callback_id += 1
 
     def register(self, callback):
@@ -129,12 +501,25 @@ class Registrable(Abstraction):
 
     def register_abstraction(self, abstraction):
         def callback(event, *args, **kwargs):
-            event_name = self.stringify_event(event)
-            abstraction.trigger_event(event_name, args=args, kwargs=kwargs)
+            abstraction.trigger_event(event, args=args, kwargs=kwargs)
 
-        self._register(callback)
+        self._register(callback, abstraction)
         return self.generate_abstraction_caller(self.callback_id - 1)
 
+    def client_event_id(self, callback_id, event):
+        client = self.clients[callback_id]
+        event_id = client.event_id(event)
+        if event_id >= len(client.EVENTS):
+            raise Exception(
+                f"{type(client).__name__} must list {client.event_names[event_id]} "
+                "in EVENTS to receive it from peers"
+            )
+        return event_id
+
+    def is_unbatched(self, callback_id, event_id):
+        client = self.clients[callback_id]
+        return client is not None and event_id in client.unbatched_ids
+
     def generate_caller(self, callback_id):
         pass
 
@@ -1,3 +1,5 @@
+from collections import deque
+
 from basic_abstraction.base import Registrable
 from basic_abstraction.link import PerfectLink
 
@@ -14,6 +16,10 @@ class Broadcast(Registrable):
     Abstraction object must go through the generate_abstraction_caller method
     instead of using the broadcast method directly.
 
+    With metrics enabled (see ./base.py), broadcasts count the messages they
+    broadcast and deliver. Reliable broadcasts also count the messages they
+    relay, the duplicates they receive, and the messages they give up as lost.
+
     """
 
     def __init__(self, link):
@@ -23,7 +29,13 @@ class Broadcast(Registrable):
         self.process_number = self.link.process_number
         self.send = link.register_abstraction(self)
 
-    def broadcast(self, callback_id, args=(), kwargs={}):
+    def _start_metrics(self):
+        super()._start_metrics()
+        labels = self.metric_labels
+        self.broadcasts = self.metrics.counter("broadcasts", **labels)
+        self.deliveries = self.metrics.counter("deliveries", **labels)
+
+    def broadcast(self, callback_id, args=(), kwargs={}, urgent=False):
         pass
 
     def receive(self, source_number, callback_id, args=(), kwargs={}):
@@ -34,9 +46,12 @@ class Broadcast(Registrable):
 
     def generate_abstraction_caller(self, callback_id):
         def broadcaster(event, args=(), kwargs={}):
-            event_name = self.stringify_event(event)
-            args = (event_name, self.process_number, *args)
-            self.trigger_event(self.broadcast, args=(callback_id, args, kwargs))
+            event_id = self.client_event_id(callback_id, event)
+            urgent = self.is_unbatched(callback_id, event_id)
+            args = (event_id, self.process_number, *args)
+            self.trigger_event(
+                self.broadcast, args=(callback_id, args, kwargs, urgent)
+            )
 
         return broadcaster
 
@@ -49,17 +64,25 @@ class BestEffortBroadcast(Broadcast):
 
     """
 
+    EVENTS = ("receive",)
+
     def __init__(self, link):
         super().__init__(link)
         self.logger = Logging(self.process_number, "BEB")
 
-    def broadcast(self, callback_id, args=(), kwargs={}):
+    def broadcast(self, callback_id, args=(), kwargs={}, urgent=False):
         self.logger.log_debug(f"Broadcasting {(args, kwargs)}")
+        if self.metrics is not None:
+            self.broadcasts.increment()
         for peer in self.peers:
-            self.send(peer, self.receive, args=(callback_id, args, kwargs))
+            self.send(
+                peer, self.receive, args=(callback_id, args, kwargs), urgent=urgent
+            )
 
     def receive(self, source_number, callback_id, args=(), kwargs={}):
         self.logger.log_debug(f"Receiving {(args, kwargs)} from {source_number}")
+        if self.metrics is not None:
+            self.deliveries.increment()
         self.callback(callback_id, args=args, kwargs=kwargs)
 
 
@@ -73,126 +96,271 @@ class EagerReliableBroadcast(Broadcast):
     This class does not use the BestEffortBroadcast class in its implementation
     for convenience. It acts as if, though.
 
+    Messages are identified by their original source and its timestamp, the
+    sequence number of the message among those it broadcast. Delivered
+    messages are tracked per original source by a watermark, below which
+    every message was delivered, and the set of messages delivered above it.
+    If more than max_concurrent_messages messages are delivered above the
+    watermark, the oldest missing messages are given up as lost, moving the
+    watermark past them. Such messages are logged and counted as skipped, as
+    they are not delivered if they arrive afterwards.
+
     """
 
+    EVENTS = ("receive",)
+
     def __init__(self, link, max_concurrent_messages=20):
         super().__init__(link)
-        self.delivered = [None] * max_concurrent_messages
-        self.delivered_cycle = 0
+        self.max_concurrent_messages = max_concurrent_messages
+        self.delivered = {}
         self.timestamp = 0
         self.logger = Logging(self.process_number, "ERB")
 
-    def register_delivered(self, message):
-        self.delivered[self.delivered_cycle] = message
-        self.delivered_cycle = (self.delivered_cycle + 1) % len(self.delivered)
-
-    def broadcast(self, callback_id, args=(), kwargs={}):
+    def _start_metrics(self):
+        super()._start_metrics()
+        labels = self.metric_labels
+        self.duplicates = self.metrics.counter("duplicates", **labels)
+        self.relays = self.metrics.counter("relays", **labels)
+        self.skipped = self.metrics.counter("skipped", **labels)
+
+    def is_delivered(self, timestamp, original_source):
+        delivered = self.delivered.get(original_source)
+        if delivered is None:
+            return False
+        watermark, above_watermark = delivered
+        return timestamp < watermark or timestamp in above_watermark
+
+    def register_delivered(self, timestamp, original_source):
+        delivered = self.delivered.setdefault(original_source, [0, set()])
+        watermark, above_watermark = delivered
+        above_watermark.add(timestamp)
+        if len(above_watermark) > self.max_concurrent_messages:
+            lowest = min(above_watermark)
+            self.logger.log_debug(
+                f"Giving up messages {watermark} to {lowest - 1} "
+                f"of {original_source} as lost"
+            )
+            if self.metrics is not None:
+                self.skipped.increment(lowest - watermark)
+            watermark = lowest
+        while watermark in above_watermark:
+            above_watermark.remove(watermark)
+            watermark += 1
+        delivered[0] = watermark
+
+    def broadcast(self, callback_id, args=(), kwargs={}, urgent=False):
         self.logger.log_debug(f"Broadcasting {(kwargs)}")
         message = (self.timestamp, self.process_number, callback_id, args, kwargs)
         self.timestamp += 1
-        self._broadcast(message)
+        if self.metrics is not None:
+            self.broadcasts.increment()
+        self._broadcast(message, urgent)
 
     def receive(
         self, source_number, timestamp, original_source, callback_id, args=(), kwargs={}
     ):
-        message = (timestamp, original_source, callback_id, args, kwargs)
-        if message not in self.delivered:
+        if not self.is_delivered(timestamp, original_source):
+            message = (timestamp, original_source, callback_id, args, kwargs)
             self.logger.log_debug(f"Receiving {(args, kwargs)} from {original_source}")
-            self.register_delivered(message)
+            self.register_delivered(timestamp, original_source)
+            if self.metrics is not None:
+                self.deliveries.increment()
+                self.relays.increment()
             self.callback(callback_id, args=args, kwargs=kwargs)
-            self._broadcast(message)
+            self._broadcast(message, self.is_unbatched(callback_id, args[0]))
+        elif self.metrics is not None:
+            self.duplicates.increment()
 
-    def _broadcast(self, message):
+    def _broadcast(self, message, urgent=False):
         for peer in self.peers:
-            self.send(peer, self.receive, args=message)
+            self.send(peer, self.receive, args=message, urgent=urgent)
 
 
-if __name__ == "__main__":
-    import time
-    from basic_abstraction.base import Abstraction
+class LazyReliableBroadcast(EagerReliableBroadcast):
+    """This class implements a lazy reliable broadcast.
 
-    print("STARTING BEB")
+    Uses:
+        - BestEffortBroadcast (in theory)
+        - PerfectLink (in practice)
+        - PerfectFailureDetector
 
-    class TestBEB(Abstraction):
-        def __init__(self, process_number):
-            super().__init__()
-            self.process_number = process_number
-            self.link = PerfectLink(self.process_number)
-            self.beb = BestEffortBroadcast(self.link)
-            self.broadcast = self.beb.register_abstraction(self)
+    Unlike the eager reliable broadcast, a delivered message is only relayed
+    once its original source is detected to have crashed, such that a
+    broadcast costs a message per peer as long as nobody crashes. Received
+    messages are kept for that purpose, at most max_kept_messages per original
+    source, or all of them if None: older messages are assumed to have
+    reached every peer. Evicted messages are logged and counted as evictions,
+    as they are not relayed if their source crashes.
 
-        def deliver(self, source_number, message):
-            print(f"{self.process_number}: {message} from {source_number}")
+    It may replace an EagerReliableBroadcast, to which it adds the failure
+    detector as a requirement.
 
-        def start(self):
-            super().start()
-            self.link.start()
-            self.beb.start()
+    """
 
-        def stop(self):
-            super().stop()
-            self.link.stop()
-            self.beb.stop()
-
-    test0 = TestBEB(0)
-    test1 = TestBEB(1)
-    test2 = TestBEB(2)
-    test0.start()
-    test1.start()
-    test2.start()
-    test0.beb.add_peers(0, 1, 2)
-    test1.beb.add_peers(0, 1, 2)
-    test2.beb.add_peers(0, 1, 2)
-
-    test0.broadcast(TestBEB.deliver, args=("Hello",))
-    test1.broadcast(TestBEB.deliver, args=("LEL",))
-    test2.broadcast(TestBEB.deliver, args=("lolilol",))
-
-    time.sleep(1)
-    test0.stop()
-    test1.stop()
-    test2.stop()
-
-    print()
-    print("STARTING ERB")
-
-    class TestERB(Abstraction):
-        def __init__(self, process_number):
+    def __init__(self, link, pfd, max_concurrent_messages=20, max_kept_messages=20):
+        super().__init__(link, max_concurrent_messages)
+        self.max_kept_messages = max_kept_messages
+        self.pfd = pfd
+        self.pfd.subscribe_abstraction(self, self.peer_failure)
+        self.detected = set()
+        self.received = {}
+        self.logger = Logging(self.process_number, "LRB")
+
+    def _start_metrics(self):
+        super()._start_metrics()
+        self.evictions = self.metrics.counter("evictions", **self.metric_labels)
+
+    def receive(
+        self, source_number, timestamp, original_source, callback_id, args=(), kwargs={}
+    ):
+        if not self.is_delivered(timestamp, original_source):
+            message = (timestamp, original_source, callback_id, args, kwargs)
+            self.logger.log_debug(f"Receiving {(args, kwargs)} from {original_source}")
+            self.register_delivered(timestamp, original_source)
+            if self.metrics is not None:
+                self.deliveries.increment()
+            self.callback(callback_id, args=args, kwargs=kwargs)
+
+            urgent = self.is_unbatched(callback_id, args[0])
+            if original_source in self.detected:
+                if self.metrics is not None:
+                    self.relays.increment()
+                self._broadcast(message, urgent)
+            elif original_source != self.process_number:
+                self.keep(message, urgent)
+        elif self.metrics is not None:
+            self.duplicates.increment()
+
+    def keep(self, message, urgent):
+        original_source = message[1]
+        if original_source not in self.received:
+            self.received[original_source] = deque(maxlen=self.max_kept_messages)
+        received = self.received[original_source]
+        if len(received) == received.maxlen:
+            evicted, _ = received[0]
+            self.logger.log_debug(
+                f"Evicting message {evicted[0]} of {original_source} unrelayed"
+            )
+            if self.metrics is not None:
+                self.evictions.increment()
+        received.append((message, urgent))
+
+    def peer_failure(self, process_number):
+        self.logger.log_debug(f"Relaying the messages of {process_number}")
+        self.detected.add(process_number)
+        for message, urgent in self.received.pop(process_number, ()):
+            if self.metrics is not None:
+                self.relays.increment()
+            self._broadcast(message, urgent)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from basic_abstraction.base import Abstraction
+    from basic_abstraction.failure_detector import PerfectFailureDetector
+    from utils import Countdown, report_latencies
+
+    parser = argparse.ArgumentParser(description="Broadcasts microbenchmark.")
+    parser.add_argument(
+        "--peers",
+        type=int,
+        default=3,
+        help="Number of peers (default: 3).",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=200,
+        help="Number of broadcasts (default: 200).",
+    )
+    parser.add_argument(
+        "--loopback",
+        action="store_true",
+        help="Let the peers skip the transport, as they share this process.",
+    )
+    arguments = parser.parse_args()
+
+    PerfectLink.LOOPBACK = arguments.loopback
+
+    delivered = Countdown()
+
+    class Test(Abstraction):
+        EVENTS = ("deliver",)
+
+        def __init__(self, process_number, broadcast_class):
             super().__init__()
             self.process_number = process_number
             self.link = PerfectLink(self.process_number)
-            self.erb = EagerReliableBroadcast(self.link)
-            self.broadcast = self.erb.register_abstraction(self)
+            self.pfd = None
+            if broadcast_class is LazyReliableBroadcast:
+                self.pfd = PerfectFailureDetector(self.link)
+                self.rb = broadcast_class(self.link, self.pfd)
+            else:
+                self.rb = broadcast_class(self.link)
+            self.broadcast = self.rb.register_abstraction(self)
             # Logging.set_debug(self.process_number, "LINK", True)
 
-        def deliver(self, source_number, message):
-            print(f"{self.process_number}: {message} from {source_number}")
+        def deliver(self, source_number, iteration):
+            delivered.count_down()
+
+        def add_peers(self, *peers):
+            if self.pfd is not None:
+                self.pfd.add_peers(*(set(peers) - {self.process_number}))
+            self.rb.add_peers(*peers)
 
         def start(self):
             super().start()
             self.link.start()
-            self.erb.start()
+            if self.pfd is not None:
+                self.pfd.start()
+            self.rb.start()
 
         def stop(self):
             super().stop()
             self.link.stop()
-            self.erb.stop()
-
-    test0 = TestERB(0)
-    test1 = TestERB(1)
-    test2 = TestERB(2)
-
-    test0.start()
-    test1.start()
-    test2.start()
-    test0.erb.add_peers(2)
-    test1.erb.add_peers(2)
-    test2.erb.add_peers(0, 1, 2)
-    test0.broadcast(TestERB.deliver, args=("Hello",))
-    test1.broadcast(TestERB.deliver, args=("LEL",))
-    test2.broadcast(TestERB.deliver, args=("lolilol",))
-
-    time.sleep(1)
-    test0.stop()
-    test1.stop()
-    test2.stop()
+            if self.pfd is not None:
+                self.pfd.stop()
+            self.rb.stop()
+
+    peers = range(arguments.peers)
+    for broadcast_class in (
+        BestEffortBroadcast,
+        EagerReliableBroadcast,
+        LazyReliableBroadcast,
+    ):
+        name = broadcast_class.__name__
+        tests = [Test(process_number, broadcast_class) for process_number in peers]
+        for test in tests:
+            test.add_peers(*peers)
+            test.start()
+
+        # Latency, until every peer delivered each broadcast
+        latencies = []
+        for iteration in range(arguments.iterations):
+            delivered.reset(arguments.peers)
+            start = time.perf_counter()
+            tests[0].broadcast(Test.deliver, args=(iteration,))
+            if not delivered.wait(Abstraction.TIMEOUT):
+                raise Exception("Broadcasts should all be delivered")
+            latencies.append(time.perf_counter() - start)
+        report_latencies(f"{name} to {arguments.peers} peers", latencies)
+
+        # Throughput, broadcasting without waiting for deliveries
+        delivered.reset(arguments.iterations * arguments.peers)
+        start = time.perf_counter()
+        for iteration in range(arguments.iterations):
+            tests[0].broadcast(Test.deliver, args=(iteration,))
+        if not delivered.wait(10 * Abstraction.TIMEOUT):
+            raise Exception("Broadcasts should all be delivered")
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name}: {arguments.iterations / elapsed:.0f} broadcasts/s, "
+            f"{arguments.iterations * arguments.peers / elapsed:.0f} deliveries/s"
+        )
+
+        for test in tests:
+            test.stop()
+        # Relays may still be in flight to the next peers' sockets
+        time.sleep(0.5)
@@ -0,0 +1,90 @@
+import pickle
+import struct
+
+
+class PickleCodec:
+    """This class implements the wire codec of the perfect links.
+
+    A link message is a (callback_id, args, kwargs) triple, pickled with the
+    highest protocol. Pickled data starts with the pickle protocol byte
+    (0x80), such that it is told apart from the framings below by its first
+    byte.
+
+    Several encoded messages may be packed in a single batch, each of them
+    prefixed by its length. Conversely, a message may be split in fragments,
+    each of them carrying the message id, its index and the fragment count.
+    Framings are packed at fixed width with struct.
+
+    Messages are not packed field by field: the C pickle module encodes and
+    decodes them faster than struct layouts driven from Python, even for
+    messages made of a few integers such as heartbeats, at the cost of more
+    bytes on the wire.
+
+    """
+
+    BATCH_FORMAT = 0x03
+    FRAGMENT_FORMAT = 0x04
+    PICKLE = 0x80
+
+    BATCH_OVERHEAD = 1
+    BATCH_ITEM_OVERHEAD = 2
+
+    LENGTH = struct.Struct("!H")
+    FRAGMENT_HEADER = struct.Struct("!BIHH")
+
+    def encode(self, message):
+        return pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+    def pack_batch(self, messages):
+        chunks = [bytes((self.BATCH_FORMAT,))]
+        for message in messages:
+            chunks.append(self.LENGTH.pack(len(message)))
+            chunks.append(message)
+        return b"".join(chunks)
+
+    def unpack_batch(self, data):
+        """Returns the messages of a batch.
+
+        Raises ValueError if the batch is truncated.
+
+        """
+        messages = []
+        offset = self.BATCH_OVERHEAD
+        while offset < len(data):
+            if offset + self.BATCH_ITEM_OVERHEAD > len(data):
+                raise ValueError(f"Truncated batch of {len(data)} bytes")
+            (length,) = self.LENGTH.unpack_from(data, offset)
+            offset += self.BATCH_ITEM_OVERHEAD
+            if offset + length > len(data):
+                raise ValueError(f"Truncated batch of {len(data)} bytes")
+            messages.append(data[offset : offset + length])
+            offset += length
+        return messages
+
+    def fragment(self, data, message_id, max_length):
+        size = max_length - self.FRAGMENT_HEADER.size
+        count = -(-len(data) // size)
+        if count > 0xFFFF:
+            raise ValueError(f"Message of {len(data)} bytes has too many fragments")
+        return [
+            self.FRAGMENT_HEADER.pack(self.FRAGMENT_FORMAT, message_id, index, count)
+            + data[index * size : (index + 1) * size]
+            for index in range(count)
+        ]
+
+    def unpack_fragment(self, data):
+        """Returns the message id, index and count of a fragment, and its data.
+
+        Raises ValueError if the fragment is truncated or its index is not
+        below its count.
+
+        """
+        if len(data) < self.FRAGMENT_HEADER.size:
+            raise ValueError(f"Truncated fragment of {len(data)} bytes")
+        _, message_id, index, count = self.FRAGMENT_HEADER.unpack_from(data)
+        if not 0 <= index < count:
+            raise ValueError(f"Fragment {index} of a message of {count} fragments")
+        return message_id, index, count, data[self.FRAGMENT_HEADER.size :]
@@ -1,4 +1,5 @@
 import time
+from collections import deque
 
 from basic_abstraction.broadcast import BestEffortBroadcast
 from basic_abstraction.failure_detector import PerfectFailureDetector
@@ -9,7 +10,15 @@ from utils import Logging
 
 
 class Consensus(Subscriptable):
-    """This abstract  class implements a generic consensus algorithm."""
+    """This abstract  class implements a generic consensus algorithm.
+
+    WINDOW is the number of instances that may be proposed to at once.
+    Consensus algorithms relying on a leader may take it from a leader
+    election (see follow_leader_election).
+
+    """
+
+    WINDOW = 1
 
     def __init__(
         self,
@@ -25,6 +34,9 @@ class Consensus(Subscriptable):
     def propose(self, value):
         pass
 
+    def follow_leader_election(self, lel):
+        pass
+
 
 class HierarchicalConsensus(Consensus):
     """This class implements the hierchical consensus algorithm.
@@ -40,6 +52,8 @@ class HierarchicalConsensus(Consensus):
 
     """
 
+    EVENTS = ("receive", "finished")
+
     def __init__(self, link, pfd, beb):
         super().__init__(link)
         self.beb = beb
@@ -118,17 +132,282 @@ class HierarchicalConsensus(Consensus):
             self.finished_peers = {peer: False for peer in self.peers - self.detected}
 
 
+class MultiPaxosConsensus(Consensus):
+    """This class implements a leader-based consensus in the style of Multi-Paxos.
+
+    Uses:
+        - PerfectFailureDetector
+        - BestEffortBroadcast
+        - PerfectLink
+
+    As with the hierarchical consensus, the leader is the non-detected peer of
+    highest rank, every peer proposes once per consensus instance, and the
+    subscribed callbacks are called with each decision. Instances are numbered
+    by slots, a peer's successive proposals being assigned to successive slots.
+
+    Only the leader's proposals are decided. The leader broadcasts its proposal
+    for a slot, decides once a majority of the non-detected peers accepted it,
+    and broadcasts the decision. A stable leader thus decides in one round trip
+    and the other peers half a round trip later, whatever the number of peers,
+    instead of one message delay per peer. The leader may have up to WINDOW
+    slots undecided at once, decisions are delivered in slot order.
+
+    Proposals are made under ballots, (round, process number) pairs, and peers
+    ignore the proposals of ballots lower than the last they promised to. The
+    first leader owns the first ballot. When the failure detector reports the
+    leader crashed, the next leader picks a higher ballot and asks every
+    non-detected peer for the values it accepted or decided. It then proposes
+    again, under its own ballot, the value of highest ballot of each undecided
+    slot, before its own proposals.
+
+    If it follows a leader election, the leader is the one it elected, and
+    the next leader only waits for the promises of a majority of the
+    non-detected peers, as the previous leader may not be detected yet.
+    Peers reject the prepares and proposals of lower ballots than the one
+    they promised to, such that a former leader elected again, whose ballot
+    was overtaken meanwhile, recovers with a higher ballot.
+
+    """
+
+    EVENTS = ("prepare", "promise", "accept", "acknowledge", "decide", "reject")
+    UNBATCHED_EVENTS = ("accept", "acknowledge", "decide", "reject")
+
+    WINDOW = 16
+    # Number of delivered decisions reported to a recovering leader
+    LOG_SIZE = 1024
+
+    def __init__(self, link, pfd, beb):
+        super().__init__(link)
+        self.send = self.link.register_abstraction(self)
+        self.beb = beb
+        self.broadcast = self.beb.register_abstraction(self)
+
+        self.pfd = pfd
+        self.pfd.subscribe_abstraction(self, self.peer_failure)
+
+        self.peers = {self.process_number}
+        self.beb.add_peers(self.process_number)
+        self.detected = set()
+        self.leader = None
+        self.lel = None
+
+        # Acceptor
+        self.promised = None
+        self.accepted = {}
+
+        # Learner
+        self.delivered = 0
+        self.decisions = {}
+        self.log = {}
+
+        # Proposer
+        self.pending = deque()
+        self.ballot = None
+        self.prepared = False
+        self.promises = {}
+        self.recovered = {}
+        self.next_slot = 0
+        self.acknowledgements = {}
+
+        self.logger = Logging(self.process_number, "MPC")
+
+    def add_peers(self, *peers):
+        self.beb.add_peers(*peers)
+        self.pfd.add_peers(*peers)
+        self.peers.update(peers)
+
+    def follow_leader_election(self, lel):
+        self.lel = lel
+        self.lel.subscribe_abstraction(self, self.new_leader)
+
+    def start(self):
+        self.leader = min(self.peers - self.detected)
+        self.promised = (0, self.leader)
+        if self.leader == self.process_number:
+            self.ballot = self.promised
+            self.prepared = True
+        super().start()
+
+    def peer_failure(self, process_number):
+        self.logger.log_debug(f"Peer {process_number} crashed")
+        self.detected.add(process_number)
+        if process_number == self.leader and self.lel is None:
+            self.new_leader(min(self.peers - self.detected))
+        elif self.leader == self.process_number:
+            # Quorums are counted among non-detected peers only
+            if not self.prepared:
+                self.check_promises()
+            for slot in list(self.acknowledgements):
+                self.check_acknowledgements(slot)
+
+    def new_leader(self, process_number):
+        if process_number == self.leader:
+            return
+        self.leader = process_number
+        if self.leader == self.process_number:
+            self.recover()
+
+    def propose(self, value):
+        self.logger.log_debug(f"New proposal {value}")
+        self.pending.append(value)
+        self.propose_pending()
+
+    # Proposer
+    def recover(self):
+        self.ballot = (self.promised[0] + 1, self.process_number)
+        self.logger.log_debug(f"Recovering with ballot {self.ballot}")
+        self.prepared = False
+        self.promises = {}
+        self.acknowledgements = {}
+        self.broadcast(self.prepare, args=(self.ballot, self.delivered))
+
+    def promise(self, source_number, ballot, accepted, decided):
+        if ballot != self.ballot or self.prepared or source_number in self.detected:
+            return
+        self.promises[source_number] = (accepted, decided)
+        self.check_promises()
+
+    def check_promises(self):
+        alive = self.peers - self.detected
+        if self.lel is None and not alive <= set(self.promises):
+            return
+        if 2 * len(alive & set(self.promises)) <= len(alive):
+            return
+        values = {}
+        for accepted, _ in self.promises.values():
+            for slot, (ballot, value) in accepted.items():
+                if slot not in values or values[slot][0] < ballot:
+                    values[slot] = (ballot, value)
+        recovered = {slot: value for slot, (_, value) in values.items()}
+        for _, decided in self.promises.values():
+            recovered.update(decided)
+
+        self.logger.log_debug(f"Recovered {recovered}")
+        self.recovered = {
+            slot: value for slot, value in recovered.items() if slot >= self.delivered
+        }
+        self.promises = {}
+        self.prepared = True
+        self.next_slot = self.delivered
+        self.propose_pending()
+
+    def propose_pending(self):
+        # Slots may have been decided under a former leader's ballot
+        self.next_slot = max(self.next_slot, self.delivered)
+        while self.prepared and self.next_slot < self.delivered + self.WINDOW:
+            slot = self.next_slot
+            if slot in self.recovered:
+                value = self.recovered.pop(slot)
+            elif slot - self.delivered < len(self.pending):
+                value = self.pending[slot - self.delivered]
+            else:
+                break
+            self.next_slot += 1
+            self.acknowledgements[slot] = (value, set())
+            self.broadcast(self.accept, args=(self.ballot, slot, value))
+
+    def acknowledge(self, source_number, ballot, slot):
+        if ballot != self.ballot or slot not in self.acknowledgements:
+            return
+        self.acknowledgements[slot][1].add(source_number)
+        self.check_acknowledgements(slot)
+
+    def reject(self, source_number, ballot, promised):
+        if ballot != self.ballot or self.leader != self.process_number:
+            return
+        self.logger.log_debug(f"Ballot {ballot} rejected for {promised}")
+        # Promising a higher ballot only makes this acceptor stricter.
+        self.promised = max(self.promised, promised)
+        self.recover()
+
+    def check_acknowledgements(self, slot):
+        value, acknowledged = self.acknowledgements[slot]
+        if len(acknowledged - self.detected) > len(self.peers - self.detected) // 2:
+            del self.acknowledgements[slot]
+            self.broadcast(self.decide, args=(slot, value))
+
+    # Acceptor
+    def prepare(self, source_number, ballot, delivered):
+        if source_number in self.detected:
+            return
+        if ballot < self.promised:
+            self.send(source_number, self.reject, args=(ballot, self.promised))
+            return
+        self.promised = ballot
+        accepted = {
+            slot: entry for slot, entry in self.accepted.items() if slot >= delivered
+        }
+        decided = {slot: value for slot, value in self.log.items() if slot >= delivered}
+        decided.update(self.decisions)
+        self.send(source_number, self.promise, args=(ballot, accepted, decided))
+
+    def accept(self, source_number, ballot, slot, value):
+        if source_number in self.detected:
+            return
+        if ballot < self.promised:
+            self.send(source_number, self.reject, args=(ballot, self.promised))
+            return
+        self.promised = ballot
+        if slot >= self.delivered:
+            self.accepted[slot] = (ballot, value)
+        self.send(source_number, self.acknowledge, args=(ballot, slot))
+
+    # Learner
+    def decide(self, source_number, slot, value):
+        if slot < self.delivered or slot in self.decisions:
+            return
+        self.decisions[slot] = value
+        while self.delivered in self.decisions:
+            value = self.decisions.pop(self.delivered)
+            self.logger.log_debug(f"Slot {self.delivered} decided on {value}")
+            self.accepted.pop(self.delivered, None)
+            self.log[self.delivered] = value
+            self.log.pop(self.delivered - self.LOG_SIZE, None)
+            self.delivered += 1
+            if self.pending:
+                self.pending.popleft()
+            self.call_callbacks(value)
+        self.propose_pending()
+
+
 if __name__ == "__main__":
+    import argparse
+
     from basic_abstraction.base import Abstraction
+    from utils import Countdown, report_latencies
+
+    parser = argparse.ArgumentParser(description="Consensus microbenchmark.")
+    parser.add_argument(
+        "--peers",
+        type=int,
+        default=3,
+        help="Number of peers (default: 3).",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=100,
+        help="Number of consensus instances (default: 100).",
+    )
+    parser.add_argument(
+        "--loopback",
+        action="store_true",
+        help="Let the peers skip the transport, as they share this process.",
+    )
+    arguments = parser.parse_args()
+
+    PerfectLink.LOOPBACK = arguments.loopback
+
+    decided = Countdown()
 
     class Test(Abstraction):
-        def __init__(self, process_number):
+        def __init__(self, process_number, consensus_class):
             super().__init__()
             self.process_number = process_number
             self.link = PerfectLink(process_number)
             self.pfd = PerfectFailureDetector(self.link)
             self.beb = BestEffortBroadcast(self.link)
-            self.hco = HierarchicalConsensus(self.link, self.pfd, self.beb)
+            self.hco = consensus_class(self.link, self.pfd, self.beb)
             self.hco.subscribe_abstraction(self, self.consensus)
             # Logging.set_debug(self.process_number, "HCO", True)
 
@@ -147,40 +426,32 @@ if __name__ == "__main__":
             self.hco.stop()
 
         def consensus(self, value):
-            print(f"{self.process_number}: decided on {value}")
-
-    test0 = Test(0)
-    test1 = Test(1)
-    test2 = Test(2)
-    test0.hco.add_peers(1, 2)
-    test1.hco.add_peers(0, 2)
-    test2.hco.add_peers(0, 1)
-    test0.start()
-    test1.start()
-    test2.start()
-
-    test0.hco.trigger_event(test0.hco.propose, kwargs={"value": "lol0"})
-    test1.hco.trigger_event(test0.hco.propose, kwargs={"value": "lil0"})
-    test2.hco.trigger_event(test0.hco.propose, kwargs={"value": "wsh0"})
-
-    time.sleep(0.5)
-
-    test0.stop()
-    test0.hco.trigger_event(test0.hco.propose, kwargs={"value": "lol1"})
-    test1.hco.trigger_event(test0.hco.propose, kwargs={"value": "lil1"})
-    test2.hco.trigger_event(test0.hco.propose, kwargs={"value": "wsh1"})
-
-    time.sleep(0.5)
-
-    test0.hco.trigger_event(test0.hco.propose, kwargs={"value": "lol2"})
-    test1.hco.trigger_event(test0.hco.propose, kwargs={"value": "lil2"})
-    test2.hco.trigger_event(test0.hco.propose, kwargs={"value": "wsh2"})
-
-    time.sleep(0.5)
-    test1.stop()
-    test0.hco.trigger_event(test0.hco.propose, kwargs={"value": "lol3"})
-    test1.hco.trigger_event(test0.hco.propose, kwargs={"value": "lil3"})
-    test2.hco.trigger_event(test0.hco.propose, kwargs={"value": "wsh3"})
-
-    time.sleep(0.5)
-    test2.stop()
+            decided.count_down()
+
+    peers = range(arguments.peers)
+    for consensus_class in (HierarchicalConsensus, MultiPaxosConsensus):
+        tests = [Test(process_number, consensus_class) for process_number in peers]
+        for test in tests:
+            test.hco.add_peers(*(set(peers) - {test.process_number}))
+            test.start()
+
+        # Every peer proposes, until every peer decided
+        latencies = []
+        for iteration in range(arguments.iterations):
+            decided.reset(arguments.peers)
+            start = time.perf_counter()
+            for test in tests:
+                value = (iteration, test.process_number)
+                test.hco.trigger_event(test.hco.propose, kwargs={"value": value})
+            if not decided.wait(Abstraction.TIMEOUT):
+                raise Exception("Every peer should decide")
+            latencies.append(time.perf_counter() - start)
+        report_latencies(
+            f"{consensus_class.__name__} decision among {arguments.peers} peers",
+            latencies,
+        )
+
+        for test in tests:
+            test.stop()
+        # Messages may still be in flight to the next peers' sockets
+        time.sleep(0.5)
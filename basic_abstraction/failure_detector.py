@@ -1,10 +1,40 @@
-from threading import Thread, Lock
+from threading import Lock
 import time
 
 from basic_abstraction.base import Subscriptable
 from utils import Logging
 
 
+class RoundTripEstimator:
+    """This class implements a round-trip time estimator.
+
+    It keeps a smoothed round-trip time and its mean deviation, updated with
+    each sample like TCP does (RFC 6298). The timeout is the smoothed
+    round-trip time plus four times its deviation.
+
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.ALPHA * (rtt - self.srtt)
+
+    def timeout(self, default):
+        if self.srtt is None:
+            return default
+        return self.srtt + 4 * self.rttvar
+
+
 class PerfectFailureDetector(Subscriptable):
     """This class implements the perfect failure detector abstraction.
 
@@ -13,12 +43,44 @@ class PerfectFailureDetector(Subscriptable):
 
     This class uses hearbeats that require a response. If no response frome a
     peer came back in time, the peer is assumed to have failed. When a peer
-    fails, the subscribed callbacks are called. Timeout is chosen to be the
-    Abstraction class' TIMEOUT attribute divided by 10. Perhaps taking twice the
-    round-trip delay time would have been a better idea?
+    fails, the subscribed callbacks are called.
+
+    Timeouts adapt to each peer's round-trip time, estimated from the replies
+    to its heartbeats (see RoundTripEstimator). A peer's reply timeout is
+    bounded by MIN_TIMEOUT and MAX_TIMEOUT, and is INITIAL_TIMEOUT until its
+    first reply. A heartbeat is sent to it every PERIOD_FACTOR reply
+    timeouts, bounded by MIN_PERIOD and MAX_PERIOD. A peer is detected once
+    a heartbeat went unanswered for a reply timeout, such that failures of
+    close peers are detected sooner, and slow peers are not mistaken for
+    crashed ones. The deadlines are pushed back by the time the detector was
+    late to check them, if more than MIN_TIMEOUT, as a stalled process also
+    holds up the replies it received. The current estimates are returned by
+    get_estimates.
+
+    Any message the link received from a peer counts as a reply, and
+    heartbeats are only sent to peers the link did not receive anything from
+    for a heartbeat period. A busy peer is thus not sent any heartbeat, and
+    its round-trip time is only sampled once it gets quiet.
+
+    Failures are detected by the detect_failures event, which schedules
+    itself again with a timer (see Scheduler.call_later) at the next
+    heartbeat or deadline.
+
+    With metrics enabled (see ./base.py), the detector counts the heartbeats
+    it sent and the peers it detected, and records the round-trip times it
+    sampled and how long it was held up past its checks.
 
     """
 
+    EVENTS = ("request", "reply")
+
+    INITIAL_TIMEOUT = Subscriptable.TIMEOUT / 10
+    MIN_TIMEOUT = Subscriptable.TIMEOUT / 20
+    MAX_TIMEOUT = Subscriptable.TIMEOUT
+    MIN_PERIOD = Subscriptable.TIMEOUT / 20
+    MAX_PERIOD = Subscriptable.TIMEOUT / 5
+    PERIOD_FACTOR = 2
+
     def __init__(self, link):
         super().__init__()
         self.link = link
@@ -27,59 +89,176 @@ class PerfectFailureDetector(Subscriptable):
 
         self.peers = set()
         self.detected = set()
-        self.correct = set()
+
+        self.heartbeat_id = 0
+        self.heartbeats = {}
+        self.unanswered = {}
+        self.next_heartbeat = {}
+        self.estimators = {}
+        self.next_check = None
 
         self.lock = Lock()
-        self.worker = Thread(target=self.detect_failures)
         self.logger = Logging(self.process_number, "PFD")
 
     def start(self):
         super().start()
-        self.worker.start()
+        self.trigger_event(self.detect_failures)
+
+    def _start_metrics(self):
+        super()._start_metrics()
+        labels = self.metric_labels
+        self.heartbeats_sent = self.metrics.counter("heartbeats_sent", **labels)
+        self.detections = self.metrics.counter("detections", **labels)
+        self.round_trips = self.metrics.histogram("round_trip_seconds", **labels)
+        self.stalls = self.metrics.histogram("stall_seconds", **labels)
 
     def add_peers(self, *peers):
-        self.peers.update(peers)
+        with self.lock:
+            for peer in peers:
+                self.estimators.setdefault(peer, RoundTripEstimator())
+            self.peers.update(peers)
 
-    def request(self, source_number):
+    def request(self, source_number, heartbeat_id):
         self.logger.log_debug(f"Request from {source_number}")
-        self.send(source_number, self.reply)
+        self.send(source_number, self.reply, args=(heartbeat_id,))
 
-    def reply(self, source_number):
+    def reply(self, source_number, heartbeat_id):
         self.logger.log_debug(f"Reply from {source_number}")
+        now = time.monotonic()
+        with self.lock:
+            self.unanswered.pop(source_number, None)
+            heartbeat = self.heartbeats.pop(source_number, None)
+            # Replies to earlier heartbeats are ambiguous samples
+            if heartbeat is not None and heartbeat[0] == heartbeat_id:
+                self.estimators[source_number].sample(now - heartbeat[1])
+                if self.metrics is not None:
+                    self.round_trips.observe(now - heartbeat[1])
+
+    def get_timeout(self, peer):
+        timeout = self.estimators[peer].timeout(self.INITIAL_TIMEOUT)
+        return min(max(timeout, self.MIN_TIMEOUT), self.MAX_TIMEOUT)
+
+    def get_period(self, peer):
+        period = self.PERIOD_FACTOR * self.get_timeout(peer)
+        return min(max(period, self.MIN_PERIOD), self.MAX_PERIOD)
+
+    def get_estimates(self):
+        """Returns the round-trip estimates and timeouts of every peer."""
         with self.lock:
-            self.correct.add(source_number)
+            return {
+                peer: {
+                    "srtt": self.estimators[peer].srtt,
+                    "rttvar": self.estimators[peer].rttvar,
+                    "timeout": self.get_timeout(peer),
+                    "period": self.get_period(peer),
+                    "detected": peer in self.detected,
+                }
+                for peer in self.peers
+            }
 
     def detect_failures(self):
-        while self.alive:
-            self.send_heartbeats()
-            time.sleep(self.TIMEOUT / 10)
-            self.timeout()
+        self.trigger_later(self.check_peers(), self.detect_failures)
 
-    def send_heartbeats(self):
-        for peer in self.peers - self.detected:
-            self.send(peer, self.request)
+    def check_peers(self):
+        """Sends the heartbeats due and detects the peers not heard from.
 
-    def timeout(self):
+        Returns the delay until the next heartbeat or deadline.
+
+        """
+        now = time.monotonic()
         with self.lock:
-            for peer in self.peers - self.correct - self.detected:
-                self.logger.log_debug(f"Peer {peer} crashed")
-                self.detected.add(peer)
-                self.call_callbacks(peer)
+            stall = now - (self.next_check or now)
+            if stall > self.MIN_TIMEOUT:
+                if self.metrics is not None:
+                    self.stalls.observe(stall)
+                # The detector itself was held up, and so may the replies be.
+                for peer in self.unanswered:
+                    self.unanswered[peer] += stall
+
+            next_check = now + self.MAX_PERIOD
+            for peer in self.peers - self.detected:
+                heard = self.link.last_received.get(peer)
+                if heard is not None and heard >= self.unanswered.get(peer, heard):
+                    self.unanswered.pop(peer, None)
 
-            self.correct.clear()
+                if self.next_heartbeat.get(peer, now) <= now:
+                    period = self.get_period(peer)
+                    if heard is not None and now - heard < period:
+                        # The peer's own traffic proves it alive
+                        self.next_heartbeat[peer] = heard + period
+                    else:
+                        self.send_heartbeat(peer, now)
+                        self.next_heartbeat[peer] = now + period
+                next_check = min(next_check, self.next_heartbeat[peer])
+
+                # Time of the oldest heartbeat not answered yet
+                sent = self.unanswered.get(peer)
+                if sent is None:
+                    continue
+                deadline = sent + self.get_timeout(peer)
+                if deadline <= now:
+                    self.logger.log_debug(f"Peer {peer} crashed")
+                    self.detected.add(peer)
+                    if self.metrics is not None:
+                        self.detections.increment()
+                    self.call_callbacks(peer)
+                    continue
+                next_check = min(next_check, deadline)
+            self.next_check = next_check
+        return max(next_check - now, 0)
+
+    def send_heartbeat(self, peer, now):
+        self.heartbeat_id += 1
+        self.heartbeats[peer] = (self.heartbeat_id, now)
+        self.unanswered.setdefault(peer, now)
+        if self.metrics is not None:
+            self.heartbeats_sent.increment()
+        self.send(peer, self.request, args=(self.heartbeat_id,))
 
 
 if __name__ == "__main__":
+    import argparse
+
     from basic_abstraction.base import Abstraction
     from basic_abstraction.link import PerfectLink
+    from utils import Countdown, report_latencies
+
+    parser = argparse.ArgumentParser(description="Failure detector microbenchmark.")
+    parser.add_argument(
+        "--peers",
+        type=int,
+        default=3,
+        help="Number of peers, at least 2 (default: 3).",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=5,
+        help="Number of crashes detected, each among new peers (default: 5).",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=float,
+        default=0.5,
+        help="Seconds the peers run before a crash (default: 0.5).",
+    )
+    parser.add_argument(
+        "--loopback",
+        action="store_true",
+        help="Let the peers skip the transport, as they share this process.",
+    )
+    arguments = parser.parse_args()
 
-    timescale = 0.1
+    PerfectLink.LOOPBACK = arguments.loopback
+
+    detected = Countdown()
 
     class Test(Abstraction):
-        def __init__(self, process_number):
+        def __init__(self, process_number, crashing):
             super().__init__()
             self.link = PerfectLink(process_number)
             self.process_number = self.link.process_number
+            self.crashing = crashing
             self.pfd = PerfectFailureDetector(self.link)
             self.pfd.subscribe_abstraction(self, self.crashed)
             # Logging.set_debug(self.process_number, "PFD", True)
@@ -95,22 +274,34 @@ if __name__ == "__main__":
             self.pfd.stop()
 
         def crashed(self, peer):
-            print(f"{self.link.process_number}: peer {peer} crashed")
-
-    test0 = Test(0)
-    test1 = Test(1)
-    test2 = Test(2)
-
-    test0.pfd.add_peers(1, 2)
-    test1.pfd.add_peers(0, 2)
-    test2.pfd.add_peers(0, 1)
-    test0.start()
-    test1.start()
-    test2.start()
-
-    time.sleep(15 * timescale)
-    test1.stop()
-    time.sleep(15 * timescale)
-    test0.stop()
-    time.sleep(15 * timescale)
-    test2.stop()
+            if peer == self.crashing:
+                detected.count_down()
+            else:
+                print(f"{self.process_number}: peer {peer} falsely detected")
+
+    # The last peer crashes, once the others estimated their round trips
+    crashing = arguments.peers - 1
+    latencies = []
+    for iteration in range(arguments.iterations):
+        peers = range(arguments.peers)
+        tests = [Test(process_number, crashing) for process_number in peers]
+        for test in tests:
+            test.pfd.add_peers(*(set(peers) - {test.process_number}))
+            test.start()
+        time.sleep(arguments.warmup)
+
+        detected.reset(arguments.peers - 1)
+        start = time.perf_counter()
+        tests[crashing].stop()
+        if not detected.wait(2 * Abstraction.TIMEOUT):
+            raise Exception("The crash should be detected by every peer")
+        latencies.append(time.perf_counter() - start)
+
+        for test in tests[:crashing]:
+            test.stop()
+        # Messages may still be in flight to the next peers' sockets
+        time.sleep(0.5)
+    report_latencies(
+        f"PerfectFailureDetector crash detection among {arguments.peers} peers",
+        latencies,
+    )
@@ -1,3 +1,5 @@
+import time
+
 from basic_abstraction.base import Subscriptable
 
 from utils import Logging
@@ -8,7 +10,7 @@ class LeaderElection(Subscriptable):
 
     Uses:
         - PerfectFailureDetector
-        - HierarchicalConsensus
+        - HierarchicalConsensus (or any Consensus)
 
     A peer's rank is greater than another's iff its process number is strictly
     lower than the other's. All sbscribed methods are called whenever a new
@@ -64,24 +66,212 @@ class LeaderElection(Subscriptable):
             self.election()
 
 
+class LeaseLeaderElection(Subscriptable):
+    """This class implements a hierarchical leader election abstraction with leases.
+
+    Uses:
+        - PerfectFailureDetector
+        - PerfectLink
+
+    As with LeaderElection, the leader is the peer of highest rank, but it is
+    not agreed on through consensus: each peer follows the peer of highest
+    rank it neither detected nor saw the lease of expire. The leader holds a
+    lease, which it renews every RENEWAL_PERIOD. Peers grant the lease to the
+    peer they follow for LEASE_DURATION from their reception of the renewal,
+    and the leader holds it for LEASE_DURATION from its sending of the
+    renewal once a strict majority of the non-detected peers granted it (see
+    holds_lease). Failures of peers other than the leader thus do not cause
+    any election.
+
+    Once the lease a peer granted expired, or once it detected the leader and
+    the lease expired, it follows the leader's successor by rank, and grants
+    the successor's lease from then on. The leader's crash is thus handled
+    after LEASE_DURATION without waiting for the failure detector, and a
+    leader that is merely late to renew its lease stopped holding it before
+    its successor may hold one. Such a leader is followed again once its
+    renewals arrive again, after the lease granted to its successor expired.
+    The subscribed methods are called with each new leader.
+
+    """
+
+    EVENTS = ("renew", "grant")
+    UNBATCHED_EVENTS = ("renew", "grant")
+
+    LEASE_DURATION = Subscriptable.TIMEOUT / 10
+    RENEWAL_PERIOD = LEASE_DURATION / 3
+
+    def __init__(self, link, pfd):
+        super().__init__()
+        self.link = link
+        self.process_number = self.link.process_number
+        self.send = self.link.register_abstraction(self)
+
+        self.pfd = pfd
+        self.pfd.subscribe_abstraction(self, self.peer_failure)
+
+        self.peers = {self.process_number}
+        self.detected = set()
+        self.expired = set()
+        self.leader = None
+        self.checking_lease = False
+
+        # Lease granted by this peer, and held by it when leader
+        self.granted_until = 0
+        self.lease_until = 0
+        self.renewal_id = 0
+        self.renewals = {}
+
+        self.logger = Logging(self.process_number, "LEL")
+
+    def start(self):
+        super().start()
+        self.trigger_event(self.update_leader)
+
+    def add_peers(self, *peers):
+        self.peers.update(peers)
+        self.pfd.add_peers(*peers)
+
+    def peer_failure(self, process_number):
+        self.logger.log_debug(f"Peer {process_number} crashed")
+        self.detected.add(process_number)
+        for renewal_id in list(self.renewals):
+            self.check_grants(renewal_id)
+        self.update_leader()
+
+    def update_leader(self):
+        leader = min(self.peers - self.detected - self.expired)
+        if leader == self.leader:
+            return
+        now = time.monotonic()
+        if self.granted_until > now:
+            # The lease granted to the previous leader has not expired yet.
+            self.trigger_later(self.granted_until - now, self.update_leader)
+            return
+        self.logger.log_debug(f"New leader {leader}")
+        self.leader = leader
+        self.call_callbacks(self.leader)
+        if self.leader == self.process_number:
+            self.renew_lease()
+            return
+        # The successor is granted a first lease to renew.
+        self.granted_until = now + self.LEASE_DURATION
+        if not self.checking_lease:
+            # First leader, or this peer stepped down.
+            self.checking_lease = True
+            self.trigger_later(self.LEASE_DURATION, self.check_lease)
+
+    def check_lease(self):
+        if self.leader == self.process_number:
+            self.checking_lease = False
+            return
+        remaining = self.granted_until - time.monotonic()
+        if remaining > 0:
+            self.trigger_later(remaining, self.check_lease)
+            return
+        self.logger.log_debug(f"Lease of {self.leader} expired")
+        self.expired.add(self.leader)
+        self.update_leader()
+        self.check_lease()
+
+    def holds_lease(self):
+        """Returns whether this peer is the leader and holds its lease."""
+        return (
+            self.leader == self.process_number
+            and time.monotonic() < self.lease_until
+        )
+
+    # Leader
+    def renew_lease(self):
+        if self.leader != self.process_number:
+            return
+        self.renewal_id += 1
+        self.renewals[self.renewal_id] = (time.monotonic(), {self.process_number})
+        # Grants to renewals older than a lease are of no use anymore.
+        for renewal_id in list(self.renewals):
+            if renewal_id <= self.renewal_id - 3:
+                del self.renewals[renewal_id]
+        for peer in self.peers - self.detected - {self.process_number}:
+            self.send(peer, self.renew, args=(self.renewal_id,))
+        self.check_grants(self.renewal_id)
+        self.trigger_later(self.RENEWAL_PERIOD, self.renew_lease)
+
+    def grant(self, source_number, renewal_id):
+        if renewal_id not in self.renewals:
+            return
+        self.renewals[renewal_id][1].add(source_number)
+        self.check_grants(renewal_id)
+
+    def check_grants(self, renewal_id):
+        sent, grants = self.renewals[renewal_id]
+        alive = self.peers - self.detected
+        if 2 * len(grants & alive) > len(alive):
+            self.lease_until = max(self.lease_until, sent + self.LEASE_DURATION)
+            del self.renewals[renewal_id]
+
+    # Followers
+    def renew(self, source_number, renewal_id):
+        if source_number in self.expired:
+            self.logger.log_debug(f"Lease of {source_number} renewed again")
+            self.expired.discard(source_number)
+            self.update_leader()
+        if source_number != self.leader:
+            return
+        self.granted_until = time.monotonic() + self.LEASE_DURATION
+        self.send(source_number, self.grant, args=(renewal_id,))
+
+
 if __name__ == "__main__":
-    import time
+    import argparse
 
     from basic_abstraction.base import Abstraction
     from basic_abstraction.link import PerfectLink
     from basic_abstraction.failure_detector import PerfectFailureDetector
     from basic_abstraction.consensus import HierarchicalConsensus
     from basic_abstraction.broadcast import BestEffortBroadcast
-    
+    from utils import Countdown, report_latencies
+
+    parser = argparse.ArgumentParser(description="Leader election microbenchmark.")
+    parser.add_argument(
+        "--peers",
+        type=int,
+        default=3,
+        help="Number of peers, at least 2 (default: 3).",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=5,
+        help="Number of leader crashes, each among new peers (default: 5).",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=float,
+        default=0.5,
+        help="Seconds the peers run before the leader crashes (default: 0.5).",
+    )
+    parser.add_argument(
+        "--loopback",
+        action="store_true",
+        help="Let the peers skip the transport, as they share this process.",
+    )
+    arguments = parser.parse_args()
+
+    PerfectLink.LOOPBACK = arguments.loopback
+
+    elected = Countdown()
+
     class Test(Abstraction):
-        def __init__(self, process_number):
+        def __init__(self, process_number, lease):
             super().__init__()
             self.process_number = process_number
             self.link = PerfectLink(process_number)
             self.pfd = PerfectFailureDetector(self.link)
             self.beb = BestEffortBroadcast(self.link)
             self.hco = HierarchicalConsensus(self.link, self.pfd, self.beb)
-            self.lel = LeaderElection(self.pfd, self.hco)
+            if lease:
+                self.lel = LeaseLeaderElection(self.link, self.pfd)
+            else:
+                self.lel = LeaderElection(self.pfd, self.hco)
             self.lel.subscribe_abstraction(self, self.new_leader)
 
         def start(self):
@@ -105,32 +295,32 @@ if __name__ == "__main__":
             self.beb.add_peers(*peers)
             self.hco.add_peers(*peers)
             self.lel.add_peers(*peers)
-        
-        def new_leader(self, leader):
-            print(f"{self.process_number}: new leader {leader}")
-    
-    test0 = Test(0)
-    test1 = Test(1)
-    test2 = Test(2)
-
-    test0.add_peers(1, 2)
-    test1.add_peers(0 ,2)
-    test2.add_peers(0, 1)
-
-    test0.start()
-    test1.start()
-    test2.start()
 
-    time.sleep(0.05)
-
-    test0.stop()
-
-    time.sleep(0.25)
+        def new_leader(self, leader):
+            # The first leader is 0, its successor 1
+            if leader == 1:
+                elected.count_down()
 
-    test1.stop()
+    peers = range(arguments.peers)
+    for lease in (False, True):
+        name = "LeaseLeaderElection" if lease else "LeaderElection"
+        latencies = []
+        for iteration in range(arguments.iterations):
+            tests = [Test(process_number, lease) for process_number in peers]
+            for test in tests:
+                test.add_peers(*(set(peers) - {test.process_number}))
+                test.start()
+            time.sleep(arguments.warmup)
 
-    time.sleep(0.25)
+            elected.reset(arguments.peers - 1)
+            start = time.perf_counter()
+            tests[0].stop()
+            if not elected.wait(2 * Abstraction.TIMEOUT):
+                raise Exception("Every peer should follow the new leader")
+            latencies.append(time.perf_counter() - start)
 
-    test0.stop()
-    test1.stop()
-    test2.stop()
+            for test in tests[1:]:
+                test.stop()
+            # Messages may still be in flight to the next peers' sockets
+            time.sleep(0.5)
+        report_latencies(f"{name} among {arguments.peers} peers", latencies)
@@ -1,115 +1,473 @@
+import asyncio
+import copy
+import itertools
 import socket
-import re
-import pickle
-import os
+import time
 from threading import Thread
 
 from basic_abstraction.base import Registrable
+from basic_abstraction.codec import PickleCodec
+from basic_abstraction.metrics import Histogram
+from basic_abstraction.transport import UnixTransport
 from utils import Logging
 
 
 class PerfectLink(Registrable):
     """This class implements a perfect link.
 
-    This class uses unix domain sockets for IPC operations. It is a Registrable
-    such that it may serve multiple abstractions. An Abstraction object must go
-    through the generate_abstraction_caller method instead of using the send
-    method directly.
+    This class uses unix domain sockets for IPC operations by default. Other
+    transports (see ./transport.py) and their peer map are set process-wide
+    through PerfectLink.set_transport. It is a Registrable such that it may
+    serve multiple abstractions. An Abstraction object must go through the
+    generate_abstraction_caller method instead of using the send method
+    directly.
+
+    Messages are pickled, and batches and fragments framed at fixed width
+    (see ./codec.py).
+
+    When running on an AsyncioScheduler, the transport is non-blocking and
+    read from the scheduler's event loop instead of a listener thread.
+
+    Messages longer than MAX_LEN bytes are split in fragments of at most
+    MAX_LEN bytes, reassembled by the destination. At most MAX_REASSEMBLIES
+    messages are reassembled at a time, an incomplete message being discarded
+    after REASSEMBLY_TIMEOUT seconds or to make room for a new one. Messages
+    are limited to MAX_MESSAGE_LEN bytes.
+
+    Batching is enabled by setting BATCH_WINDOW to a number of seconds.
+    Messages for the same destination are then held for at most BATCH_WINDOW
+    and sent together in a single datagram of at most BATCH_SIZE bytes.
+    Messages for events an abstraction declares in its UNBATCHED_EVENTS are
+    sent immediately, along with the messages already held for the
+    destination to keep them in order.
+
+    Messages for a process whose link runs in the same interpreter, including
+    the process itself, skip the transport: they are put directly on the
+    destination's event queues. Their arguments are copied, except for
+    immutable values, such that neither side sees the other's later changes.
+    Setting LOOPBACK to False sends them through the transport as well.
+
+    The time the link last received a message from each peer is kept in
+    last_received, from which the failure detector infers their liveness.
+
+    With metrics enabled (see ./base.py), the link counts the messages sent,
+    received and dropped, and the datagrams and bytes going through the
+    transport. Datagrams the transport failed to send are counted as dropped
+    instead of only being logged. Malformed datagrams, which could not be
+    unpacked or decoded, are counted as malformed messages and dropped
+    without stopping the listener.
 
     """
 
     SEND = 0
     MAX_LEN = 1024
+    MAX_MESSAGE_LEN = 64 * 1024
+    MAX_REASSEMBLIES = 32
+    REASSEMBLY_TIMEOUT = 1
+    BATCH_WINDOW = None
+    BATCH_SIZE = MAX_LEN
+
+    TRANSPORT = UnixTransport
+    PEERS = None
+
+    LOOPBACK = True
+    IMMUTABLE_TYPES = (int, float, bool, str, bytes, type(None))
+    local_links = {}
+
+    def set_transport(transport, peers=None):
+        PerfectLink.TRANSPORT = transport
+        PerfectLink.PEERS = peers
 
     def __init__(self, process_number):
         super().__init__()
         self.process_number = process_number
+        self.codec = PickleCodec()
         self.create_socket()
         self.listener = Thread(target=self.receive)
+        self.message_ids = itertools.count()
+        self.reassemblies = {}
+        self.last_received = {}
+        self.batches = {}
         self.logger = Logging(self.process_number, "LINK")
 
     def start(self):
         super().start()
-        self.listener.start()
+        if self.LOOPBACK:
+            PerfectLink.local_links[self.process_number] = self
+        loop = self.scheduler.loop
+        if loop is None:
+            self.listener.start()
+        else:
+            self.transport.setblocking(False)
+            loop.call_soon_threadsafe(
+                loop.add_reader, self.transport.fileno(), self.receive_ready
+            )
 
-    def create_socket(self):
-        server_address = self.get_address(self.process_number)
+    def stop(self):
+        super().stop()
+        if PerfectLink.local_links.get(self.process_number) is self:
+            del PerfectLink.local_links[self.process_number]
+        loop = self.scheduler.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.close)
+        else:
+            # The listener closes the transport once its receive times out.
+            self.transport.shutdown()
 
-        try:
-            os.unlink(server_address)
-        except OSError:
-            if os.path.exists(server_address):
-                raise
+    def close(self):
+        self.scheduler.loop.remove_reader(self.transport.fileno())
+        self.transport.close()
+        self.logger.log_debug(f"is done")
+
+    def _start_metrics(self):
+        super()._start_metrics()
+        labels = self.metric_labels
+        self.messages_sent = self.metrics.counter("messages_sent", **labels)
+        self.local_messages_sent = self.metrics.counter("local_messages_sent", **labels)
+        self.messages_received = self.metrics.counter("messages_received", **labels)
+        self.messages_dropped = self.metrics.counter("messages_dropped", **labels)
+        self.messages_malformed = self.metrics.counter("messages_malformed", **labels)
+        self.message_bytes = self.metrics.histogram(
+            "message_bytes", Histogram.SIZE_BOUNDS, **labels
+        )
+        self.datagrams_sent = self.metrics.counter("datagrams_sent", **labels)
+        self.datagrams_received = self.metrics.counter("datagrams_received", **labels)
+        self.datagrams_dropped = self.metrics.counter("datagrams_dropped", **labels)
+        self.bytes_sent = self.metrics.counter("bytes_sent", **labels)
+        self.bytes_received = self.metrics.counter("bytes_received", **labels)
 
-        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        self.socket.bind(server_address)
-        self.socket.settimeout(self.TIMEOUT)
+    def create_socket(self):
+        self.transport = self.TRANSPORT(self.process_number, self.PEERS, self.TIMEOUT)
+        self.transport.open()
 
-    def send(self, destination_process, callback_id, args=(), kwargs={}):
+    def send(self, destination_process, callback_id, args=(), kwargs={}, urgent=False):
         message = (callback_id, args, kwargs)
         if self.alive:
-            data = pickle.dumps(message)
-            if len(data) > self.MAX_LEN:
+            local_link = self.local_links.get(destination_process)
+            if local_link is not None:
+                return self.send_locally(local_link, callback_id, args, kwargs)
+            data = self.codec.encode(message)
+            if self.metrics is not None:
+                self.messages_sent.increment()
+                self.message_bytes.observe(len(data))
+            if len(data) > self.MAX_MESSAGE_LEN:
                 raise Exception(
-                    f"Message exceding maximum length of {self.MAX_LEN} bytes, received {len(data)} bytes"
+                    f"Message exceding maximum length of {self.MAX_MESSAGE_LEN} bytes, received {len(data)} bytes"
                 )
             self.logger.log_debug(f"Sending {(args, kwargs)} to {destination_process}")
+            if len(data) > self.MAX_LEN:
+                datagrams = self.fragment(data)
+                if destination_process in self.batches:
+                    datagrams.insert(0, self.take_batch(destination_process))
+                return self.sendto(destination_process, datagrams)
+            if self.BATCH_WINDOW is None:
+                return self.sendto(destination_process, [data])
+            datagrams = self.batch(destination_process, data, urgent)
+            return self.sendto(destination_process, datagrams)
+        else:
+            self.logger.log_debug(f"Not send {message} to {destination_process}")
+            if self.metrics is not None:
+                self.messages_dropped.increment()
+
+    def send_locally(self, local_link, callback_id, args, kwargs):
+        destination_process = local_link.process_number
+        self.logger.log_debug(f"Sending {(args, kwargs)} to {destination_process}")
+        if self.metrics is not None:
+            self.local_messages_sent.increment()
+        if not local_link.alive:
+            if self.metrics is not None:
+                self.messages_dropped.increment()
+            return
+        args = self.isolate(args)
+        kwargs = self.isolate(kwargs)
+        local_link.last_received[self.process_number] = time.monotonic()
+        local_link.logger.log_debug(
+            f"Received {(args, kwargs)} from {self.process_number}"
+        )
+        if local_link.metrics is not None:
+            local_link.messages_received.increment()
+        local_link.callback(callback_id, args=args, kwargs=kwargs)
+
+    def isolate(self, value):
+        """Copies a message argument, sharing its immutable parts."""
+        kind = type(value)
+        if kind in self.IMMUTABLE_TYPES:
+            return value
+        if kind is tuple:
+            return tuple([self.isolate(item) for item in value])
+        if kind is list:
+            return [self.isolate(item) for item in value]
+        if kind is dict:
+            return {key: self.isolate(item) for key, item in value.items()}
+        return copy.deepcopy(value)
+
+    def sendto(self, destination_process, datagrams):
+        for i, data in enumerate(datagrams):
             try:
-                self.socket.sendto(data, self.get_address(destination_process))
+                self.transport.sendto(data, destination_process)
+            except BlockingIOError:
+                return self.send_later(destination_process, datagrams[i:])
             except Exception as e:
                 self.logger.log_debug(
-                    f"Message {message} for {destination_process} dropped"
+                    f"Datagram for {destination_process} dropped: {e}"
                 )
-        else:
-            self.logger.log_debug(f"Not send {message} to {destination_process}")
+                if self.metrics is not None:
+                    self.datagrams_dropped.increment()
+            else:
+                if self.metrics is not None:
+                    self.datagrams_sent.increment()
+                    self.bytes_sent.increment(len(data))
+
+    async def send_later(self, destination_process, datagrams):
+        """Retries sends refused by the non-blocking socket.
+
+        The destination's receive buffer is full. Like the blocking socket
+        would, a datagram is dropped if it could not be sent within TIMEOUT.
+
+        """
+        for data in datagrams:
+            deadline = time.monotonic() + self.TIMEOUT
+            while self.alive and time.monotonic() < deadline:
+                await asyncio.sleep(0.001)
+                try:
+                    self.transport.sendto(data, destination_process)
+                except BlockingIOError:
+                    continue
+                except Exception as e:
+                    self.logger.log_debug(
+                        f"Datagram for {destination_process} dropped: {e}"
+                    )
+                    if self.metrics is not None:
+                        self.datagrams_dropped.increment()
+                    break
+                else:
+                    if self.metrics is not None:
+                        self.datagrams_sent.increment()
+                        self.bytes_sent.increment(len(data))
+                    break
+            else:
+                self.logger.log_debug(f"Datagram for {destination_process} dropped")
+                if self.metrics is not None:
+                    self.datagrams_dropped.increment()
+
+    # Fragmentation
+    def fragment(self, data):
+        message_id = next(self.message_ids) % 2 ** 32
+        return self.codec.fragment(data, message_id, self.MAX_LEN)
+
+    def reassemble(self, data, source_number):
+        """Adds a fragment to its message's reassembly buffer.
+
+        Returns the message once all its fragments were received, None
+        otherwise. Malformed fragments, and fragments whose count differs
+        from the other fragments of their message, are dropped.
+
+        """
+        now = time.monotonic()
+        for key, (deadline, _) in list(self.reassemblies.items()):
+            if deadline < now:
+                self.logger.log_debug(f"Incomplete message {key} discarded")
+                del self.reassemblies[key]
+                if self.metrics is not None:
+                    self.messages_dropped.increment()
+
+        try:
+            message_id, index, count, fragment = self.codec.unpack_fragment(data)
+        except ValueError as e:
+            self.drop_malformed(source_number, e)
+            return None
+        key = (source_number, message_id)
+        if key in self.reassemblies and len(self.reassemblies[key][1]) != count:
+            self.logger.log_debug(
+                f"Fragment {index} of {key} dropped: {count} fragments, expected "
+                f"{len(self.reassemblies[key][1])}"
+            )
+            return None
+        if key not in self.reassemblies:
+            if len(self.reassemblies) >= self.MAX_REASSEMBLIES:
+                oldest = min(
+                    self.reassemblies, key=lambda key: self.reassemblies[key][0]
+                )
+                self.logger.log_debug(f"Incomplete message {oldest} discarded")
+                del self.reassemblies[oldest]
+                if self.metrics is not None:
+                    self.messages_dropped.increment()
+            self.reassemblies[key] = (now + self.REASSEMBLY_TIMEOUT, [None] * count)
+        _, fragments = self.reassemblies[key]
+        fragments[index] = fragment
+        if None in fragments:
+            return None
+        del self.reassemblies[key]
+        return b"".join(fragments)
+
+    # Batching
+    def batch(self, destination_process, data, urgent):
+        """Adds an encoded message to the destination's batch.
+
+        Returns the datagrams to send right away: the full batch if the
+        message does not fit in it, and the batch including the message if
+        it is urgent.
+
+        """
+        datagrams = []
+        batch = self.batches.get(destination_process)
+        length = len(data) + self.codec.BATCH_ITEM_OVERHEAD
+        if batch is not None and batch[0] + length > self.BATCH_SIZE:
+            datagrams.append(self.take_batch(destination_process))
+            batch = None
+
+        if batch is None:
+            if urgent:
+                return datagrams + [data]
+            batch = self.batches[destination_process] = [
+                self.codec.BATCH_OVERHEAD
+            ]
+            self.trigger_later(self.BATCH_WINDOW, self.flush, (destination_process,))
+        batch[0] += length
+        batch.append(data)
+
+        if urgent:
+            datagrams.append(self.take_batch(destination_process))
+        return datagrams
+
+    def take_batch(self, destination_process):
+        _, *messages = self.batches.pop(destination_process)
+        if len(messages) == 1:
+            return messages[0]
+        return self.codec.pack_batch(messages)
+
+    def flush(self, destination_process):
+        if destination_process in self.batches:
+            return self.sendto(
+                destination_process, [self.take_batch(destination_process)]
+            )
 
     def receive(self):
         while self.alive:
             try:
-                data, source = self.socket.recvfrom(self.MAX_LEN)
+                data, source_number = self.transport.receive(self.MAX_LEN)
             except socket.timeout:
                 continue
             else:
-                callback_id, args, kwargs = pickle.loads(data)
-                source_number = self.get_process(source)
-                self.logger.log_debug(f"Received {(args, kwargs)} from {source_number}")
-                self.callback(callback_id, args=args, kwargs=kwargs)
-        self.socket.close()
+                if self.metrics is not None:
+                    self.datagrams_received.increment()
+                    self.bytes_received.increment(len(data))
+                self.deliver(data, source_number)
+        self.transport.close()
         self.logger.log_debug(f"is done")
 
+    def receive_ready(self):
+        while self.alive:
+            try:
+                data, source_number = self.transport.receive(self.MAX_LEN)
+            except BlockingIOError:
+                return
+            else:
+                if self.metrics is not None:
+                    self.datagrams_received.increment()
+                    self.bytes_received.increment(len(data))
+                self.deliver(data, source_number)
+
+    def deliver(self, data, source_number):
+        self.last_received[source_number] = time.monotonic()
+        if not data:
+            return self.drop_malformed(source_number, "empty datagram")
+        if data[0] == self.codec.BATCH_FORMAT:
+            try:
+                messages = self.codec.unpack_batch(data)
+            except ValueError as e:
+                return self.drop_malformed(source_number, e)
+            for message in messages:
+                self.deliver(message, source_number)
+            return
+        if data[0] == self.codec.FRAGMENT_FORMAT:
+            data = self.reassemble(data, source_number)
+            if data is None:
+                return
+        try:
+            callback_id, args, kwargs = self.codec.decode(data)
+        except Exception as e:
+            # A bad datagram must not stop the listener.
+            return self.drop_malformed(source_number, e)
+        self.logger.log_debug(f"Received {(args, kwargs)} from {source_number}")
+        if self.metrics is not None:
+            self.messages_received.increment()
+        self.callback(callback_id, args=args, kwargs=kwargs)
+
+    def drop_malformed(self, source_number, error):
+        self.logger.log_debug(f"Message from {source_number} dropped: {error}")
+        if self.metrics is not None:
+            self.messages_malformed.increment()
+
     def generate_abstraction_caller(self, callback_id):
-        def sender(destination_process, event, args=(), kwargs={}):
-            event_name = self.stringify_event(event)
-            args = (event_name, self.process_number, *args)
+        def sender(destination_process, event, args=(), kwargs={}, urgent=False):
+            event_id = self.client_event_id(callback_id, event)
+            urgent = urgent or self.is_unbatched(callback_id, event_id)
+            args = (event_id, self.process_number, *args)
             self.trigger_event(
-                self.send, args=(destination_process, callback_id, args, kwargs)
+                self.send,
+                args=(destination_process, callback_id, args, kwargs, urgent),
             )
 
         return sender
 
-    def get_address(self, process_number):
-        return f"/tmp/fairlosslink{process_number}.socket"
-
-    def get_process(self, address):
-        return int(re.findall("[0-9]+", address)[0])
-
 
 if __name__ == "__main__":
-    import time
+    import argparse
+
     from basic_abstraction.base import Abstraction
+    from utils import Countdown, report_latencies
+
+    parser = argparse.ArgumentParser(description="PerfectLink microbenchmark.")
+    parser.add_argument(
+        "--peers",
+        type=int,
+        default=3,
+        help="Number of peers, at least 2 (default: 3).",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=1000,
+        help="Number of messages sent to each peer (default: 1000).",
+    )
+    parser.add_argument(
+        "--batch-window",
+        type=float,
+        default=None,
+        help="Batching window in milliseconds (default: no batching).",
+    )
+    parser.add_argument(
+        "--loopback",
+        action="store_true",
+        help="Let the peers skip the transport, as they share this process.",
+    )
+    arguments = parser.parse_args()
+
+    PerfectLink.LOOPBACK = arguments.loopback
+    if arguments.batch_window is not None:
+        PerfectLink.BATCH_WINDOW = arguments.batch_window / 1000
+
+    received = Countdown()
+    replied = Countdown()
 
     class Test(Abstraction):
+        EVENTS = ("message", "ping", "pong")
+
         def __init__(self, process_number):
             super().__init__()
             self.link = PerfectLink(process_number)
             self.send = self.link.register_abstraction(self)
             # Logging.set_debug(process_number, "LINK", True)
 
-        def print_stuff(self, source_number, string):
-            print(f"Got {string} from {source_number}")
+        def message(self, source_number, iteration):
+            received.count_down()
 
-        def print_split_stuff(self, source_number, string):
-            print(f"Got {string.split()} from {source_number}")
+        def ping(self, source_number, iteration):
+            self.send(source_number, Test.pong, args=(iteration,))
+
+        def pong(self, source_number, iteration):
+            replied.count_down()
 
         def start(self):
             super().start()
@@ -119,13 +477,49 @@ if __name__ == "__main__":
             super().stop()
             self.link.stop()
 
-    test0 = Test(0)
-    test1 = Test(1)
-    test0.start()
-    test1.start()
-    test1.send(0, Test.print_stuff, args=("Do this and that",))
-    test0.send(1, Test.print_split_stuff, args=("Do this and that",))
+    tests = [Test(process_number) for process_number in range(arguments.peers)]
+    for test in tests:
+        test.start()
+
+    # Throughput, from the first peer to all the others
+    messages = arguments.iterations * (arguments.peers - 1)
+    received.reset(messages)
+    start = time.perf_counter()
+    for iteration in range(arguments.iterations):
+        for peer in range(1, arguments.peers):
+            tests[0].send(peer, Test.message, args=(iteration,))
+    if not received.wait(10 * Abstraction.TIMEOUT):
+        raise Exception("Messages should all be received")
+    elapsed = time.perf_counter() - start
+    print(
+        f"PerfectLink: {messages / elapsed:.0f} messages/s "
+        f"to {arguments.peers - 1} peers"
+    )
+
+    # Batches filled up to BATCH_SIZE, then one byte past it
+    link = tests[0].link
+    link.BATCH_WINDOW = PerfectLink.BATCH_WINDOW or Abstraction.TIMEOUT
+    overhead = link.codec.BATCH_OVERHEAD + 2 * link.codec.BATCH_ITEM_OVERHEAD
+    first = bytes(500)
+    for extra in (0, 1):
+        link.batch(1, first, urgent=False)
+        last = bytes(link.BATCH_SIZE - overhead - len(first) + extra)
+        datagrams = link.batch(1, last, urgent=True)
+        if len(datagrams) != 1 + extra or max(map(len, datagrams)) > link.MAX_LEN:
+            raise Exception("Batches should fit in a datagram")
+    del link.BATCH_WINDOW
+
+    # Round trips, to each other peer in turn
+    latencies = []
+    for iteration in range(arguments.iterations):
+        replied.reset(1)
+        start = time.perf_counter()
+        peer = 1 + iteration % (arguments.peers - 1)
+        tests[0].send(peer, Test.ping, args=(iteration,))
+        if not replied.wait(Abstraction.TIMEOUT):
+            raise Exception("Pings should all be answered")
+        latencies.append(time.perf_counter() - start)
+    report_latencies("PerfectLink round trip", latencies)
 
-    time.sleep(1)
-    test0.stop()
-    test1.stop()
+    for test in tests:
+        test.stop()
@@ -0,0 +1,250 @@
+import bisect
+import json
+import os
+import time
+from threading import Event, Lock, Thread
+
+
+class Counter:
+    """This class implements a counter, a metric that only increases."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.value = 0
+
+    def increment(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return {"type": "counter", "value": self.value}
+
+
+class Gauge:
+    """This class implements a gauge, a metric that goes up and down.
+
+    A gauge is either set, or read from functions when snapshotted, their
+    results being summed. The latter costs nothing until read, e.g. for the
+    depth of event queues.
+
+    """
+
+    def __init__(self):
+        self.value = 0
+        self.functions = []
+
+    def set(self, value):
+        self.value = value
+
+    def add_function(self, function):
+        self.functions.append(function)
+
+    def remove_function(self, function):
+        if function in self.functions:
+            self.functions.remove(function)
+
+    def snapshot(self):
+        value = self.value
+        if self.functions:
+            value = sum(function() for function in list(self.functions))
+        return {"type": "gauge", "value": value}
+
+
+class Histogram:
+    """This class implements a histogram of observed values.
+
+    Values are counted in buckets of given upper bounds, TIME_BOUNDS (from a
+    microsecond to about 17 seconds) by default, and SIZE_BOUNDS for sizes in
+    bytes. Quantiles are interpolated within the bucket they fall in, the
+    last bucket being bounded by the largest value observed.
+
+    """
+
+    TIME_BOUNDS = tuple(1e-6 * 2 ** exponent for exponent in range(25))
+    SIZE_BOUNDS = tuple(2 ** exponent for exponent in range(4, 17))
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, bounds=None):
+        self.bounds = self.TIME_BOUNDS if bounds is None else tuple(bounds)
+        self.lock = Lock()
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = None
+
+    def observe(self, value):
+        bucket = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.sum += value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def quantile(self, quantile):
+        rank = quantile * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            if count and seen + count >= rank:
+                lower = self.bounds[bucket - 1] if bucket else 0
+                upper = self.bounds[bucket] if bucket < len(self.bounds) else self.max
+                upper = min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {
+                "type": "histogram",
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else None,
+                "max": self.max,
+            }
+            for quantile in self.QUANTILES:
+                snapshot[f"p{round(100 * quantile)}"] = self.quantile(quantile)
+        return snapshot
+
+
+class MetricsRegistry:
+    """This class implements a registry of counters, gauges and histograms.
+
+    A metric is identified by its name and labels, e.g. the process number
+    and the abstraction it measures. Asking for a metric that already exists
+    returns it, such that the metrics of the abstractions of a same process
+    and class are merged. The registry used by newly created abstractions is
+    set process-wide through Abstraction.set_metrics, and abstractions do not
+    measure anything without one.
+
+    The metrics are read in-process with snapshot, and dumped as JSON to a
+    file every period by start_dump, from a dedicated thread.
+
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+        self.dump_stopped = None
+        self.dump_thread = None
+
+    def get(self, kind, name, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = kind(*args)
+        return metric
+
+    def counter(self, name, **labels):
+        return self.get(Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self.get(Gauge, name, labels)
+
+    def histogram(self, name, bounds=None, **labels):
+        return self.get(Histogram, name, labels, bounds)
+
+    def snapshot(self):
+        """Returns the name, labels and values of every metric."""
+        with self.lock:
+            metrics = list(self.metrics.items())
+        return [
+            {"name": name, "labels": dict(labels), **metric.snapshot()}
+            for (name, labels), metric in sorted(metrics, key=lambda item: item[0])
+        ]
+
+    def dump(self, path):
+        snapshot = {"time": time.time(), "metrics": self.snapshot()}
+        # Readers never see a partially written file
+        with open(f"{path}.tmp", "w") as dump_file:
+            json.dump(snapshot, dump_file, indent=4)
+        os.replace(f"{path}.tmp", path)
+
+    def start_dump(self, path, period=1):
+        """Dumps the metrics to path every period seconds, until stop_dump."""
+        self.stop_dump()
+        self.dump_stopped = Event()
+        self.dump_thread = Thread(
+            target=self.dump_every, args=(path, period, self.dump_stopped), daemon=True
+        )
+        self.dump_thread.start()
+
+    def dump_every(self, path, period, stopped):
+        while not stopped.wait(period):
+            self.dump(path)
+        self.dump(path)
+
+    def stop_dump(self):
+        """Stops the periodic dumps, after a last one."""
+        if self.dump_stopped is not None:
+            self.dump_stopped.set()
+            self.dump_thread.join()
+            self.dump_stopped = None
+            self.dump_thread = None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from basic_abstraction.base import Abstraction
+    from basic_abstraction.voting import MajorityVoting
+    from utils import report_latencies
+
+    parser = argparse.ArgumentParser(description="Metrics overhead microbenchmark.")
+    parser.add_argument(
+        "--peers",
+        type=int,
+        default=3,
+        help="Number of peers (default: 3).",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=200,
+        help="Number of votes (default: 200).",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="JSON file the metrics are dumped to (default: none).",
+    )
+    arguments = parser.parse_args()
+
+    def measure(metrics):
+        Abstraction.set_metrics(metrics)
+        votings = [
+            MajorityVoting(number, lambda value: True, lambda value: None)
+            for number in range(arguments.peers)
+        ]
+        for voting in votings:
+            voting.add_peers(*(set(range(arguments.peers)) - {voting.process_number}))
+        for voting in votings:
+            voting.start()
+        leader = votings[votings[0].get_leader()]
+        measure.leader = leader.process_number
+
+        latencies = []
+        for iteration in range(arguments.iterations):
+            start = time.perf_counter()
+            if not leader.vote(iteration):
+                raise Exception(f"Vote {iteration} failed")
+            latencies.append(time.perf_counter() - start)
+
+        for voting in votings:
+            voting.stop()
+        Abstraction.set_metrics(None)
+        time.sleep(0.5)
+        return latencies
+
+    report_latencies("Votes without metrics", measure(None))
+    metrics = MetricsRegistry()
+    report_latencies("Votes with metrics", measure(metrics))
+
+    for metric in metrics.snapshot():
+        labels = metric.pop("labels")
+        if labels == {"abstraction": "MajorityVoting", "process": measure.leader}:
+            print(metric)
+    if arguments.output is not None:
+        metrics.dump(arguments.output)
@@ -0,0 +1,93 @@
+import heapq
+import itertools
+import time
+import traceback
+from threading import Thread, Condition
+
+
+class Timer:
+    """This class implements a timer of the TimerService.
+
+    A timer calls its callback once its deadline is reached, and again every
+    period if it is periodic, until it is cancelled.
+
+    """
+
+    def __init__(self, deadline, callback, args=(), period=None):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.period = period
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def fire(self):
+        if not self.cancelled:
+            self.callback(*self.args)
+
+
+class TimerService:
+    """This class implements a timer service.
+
+    Timers are kept in a heap ordered by deadline, and fired by a single
+    thread sleeping until the earliest deadline on the monotonic clock. The
+    thread is started with the first timer (and again in a forked process).
+
+    Callbacks are called from the timer thread and must not block, most
+    trigger an event on an abstraction (see Abstraction.trigger_later).
+    Schedulers share a process-wide timer service (see Scheduler).
+
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = Condition()
+        self.thread = None
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.monotonic() + delay, callback, args)
+        self.schedule(timer)
+        return timer
+
+    def call_every(self, period, callback, *args):
+        timer = Timer(time.monotonic() + period, callback, args, period)
+        self.schedule(timer)
+        return timer
+
+    def schedule(self, timer):
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+            heapq.heappush(self.heap, (timer.deadline, next(self.counter), timer))
+            if self.heap[0][2] is timer:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                deadline, _, timer = self.heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+
+            if timer.cancelled:
+                continue
+            try:
+                timer.fire()
+            except Exception:
+                traceback.print_exc()
+            if timer.period is not None:
+                # Skip the periods missed by a late timer
+                timer.deadline = max(
+                    timer.deadline + timer.period, time.monotonic()
+                )
+                self.schedule(timer)
@@ -0,0 +1,571 @@
+import glob
+import mmap
+import os
+import re
+import select
+import selectors
+import socket
+import struct
+import tempfile
+import time
+from collections import deque
+
+from utils import Logging
+
+
+class Transport:
+    """This abstract class implements the transport of a perfect link.
+
+    A transport carries datagrams between processes identified by their
+    process number. Addresses are given by a peer map, a dictionary mapping
+    process numbers to transport addresses.
+
+    The receive method returns a (data, source_number) pair. When blocking,
+    it raises socket.timeout if no datagram arrived within the timeout. When
+    non-blocking (see setblocking), it raises BlockingIOError if no datagram
+    is ready, and fileno returns a file descriptor that is readable whenever
+    receive may return a datagram.
+
+    The shutdown method stops the transport from accepting new peers, such
+    that its address may be reused right away, while another thread may
+    still be receiving until it closes the transport.
+
+    """
+
+    def __init__(self, process_number, peers=None, timeout=1):
+        self.process_number = process_number
+        self.peers = peers
+        self.timeout = timeout
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def setblocking(self, blocking):
+        pass
+
+    def fileno(self):
+        pass
+
+    def sendto(self, data, destination_process):
+        pass
+
+    def receive(self, max_length):
+        pass
+
+
+class UnixTransport(Transport):
+    """This class implements a transport over unix domain datagram sockets.
+
+    Peers are addressed by socket paths, /tmp/fairlosslink{n}.socket for
+    process n by default. Every peer must run on the same host.
+
+    """
+
+    def get_address(self, process_number):
+        if self.peers is not None:
+            return self.peers[process_number]
+        return f"/tmp/fairlosslink{process_number}.socket"
+
+    def get_process(self, address):
+        if self.peers is not None:
+            return self.processes[address]
+        return int(re.findall("[0-9]+", address)[0])
+
+    def open(self):
+        if self.peers is not None:
+            self.processes = {path: number for number, path in self.peers.items()}
+        server_address = self.get_address(self.process_number)
+
+        try:
+            os.unlink(server_address)
+        except OSError:
+            if os.path.exists(server_address):
+                raise
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(server_address)
+        self.socket.settimeout(self.timeout)
+
+    def close(self):
+        self.socket.close()
+
+    def setblocking(self, blocking):
+        self.socket.setblocking(blocking)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def sendto(self, data, destination_process):
+        self.socket.sendto(data, self.get_address(destination_process))
+
+    def receive(self, max_length):
+        data, address = self.socket.recvfrom(max_length)
+        return data, self.get_process(address)
+
+
+class UDPTransport(Transport):
+    """This class implements a transport over UDP.
+
+    Peers are addressed by (host, port) pairs, which must all be given in the
+    peer map. A datagram's source is identified by its source address, such
+    that datagrams from unknown addresses are ignored.
+
+    """
+
+    def open(self):
+        self.addresses = {
+            number: (socket.gethostbyname(host), port)
+            for number, (host, port) in self.peers.items()
+        }
+        self.processes = {
+            address: number for number, address in self.addresses.items()
+        }
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.addresses[self.process_number])
+        self.socket.settimeout(self.timeout)
+
+    def close(self):
+        self.socket.close()
+
+    def setblocking(self, blocking):
+        self.socket.setblocking(blocking)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def sendto(self, data, destination_process):
+        self.socket.sendto(data, self.addresses[destination_process])
+
+    def receive(self, max_length):
+        while True:
+            data, address = self.socket.recvfrom(max_length)
+            if address in self.processes:
+                return data, self.processes[address]
+
+
+class TCPTransport(Transport):
+    """This class implements a transport over TCP.
+
+    Peers are addressed by (host, port) pairs, which must all be given in the
+    peer map. Each transport listens on its own address and keeps a pool of
+    persistent outgoing connections, one per peer, opened on the first
+    datagram to that peer. A broken connection is reopened once before the
+    datagram is given up.
+
+    Datagrams are framed by their source process number and their length.
+    Incoming connections are multiplexed with a selector, whose file
+    descriptor is readable whenever one of them is. Outgoing connections
+    always block (up to the timeout), even when the transport does not.
+
+    """
+
+    FRAME_HEADER = struct.Struct("!HI")
+
+    def open(self):
+        self.blocking = True
+        self.connections = {}
+        self.buffers = {}
+        self.frames = deque()
+        self.selector = selectors.DefaultSelector()
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(self.peers[self.process_number])
+        self.server.listen()
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+    def shutdown(self):
+        # The selector forgets the closed socket, which may not be accepted on.
+        self.server.close()
+
+    def setblocking(self, blocking):
+        self.blocking = blocking
+
+    def fileno(self):
+        return self.selector.fileno()
+
+    def connect(self, destination_process):
+        connection = socket.create_connection(
+            self.peers[destination_process], timeout=self.timeout
+        )
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections[destination_process] = connection
+        return connection
+
+    def disconnect(self, destination_process):
+        connection = self.connections.pop(destination_process, None)
+        if connection is not None:
+            connection.close()
+
+    def sendto(self, data, destination_process):
+        frame = self.FRAME_HEADER.pack(self.process_number, len(data)) + data
+        try:
+            connection = self.connections.get(destination_process)
+            if connection is None:
+                connection = self.connect(destination_process)
+            connection.sendall(frame)
+        except OSError:
+            # The peer may have restarted, reconnect once.
+            self.disconnect(destination_process)
+            try:
+                self.connect(destination_process).sendall(frame)
+            except OSError:
+                self.disconnect(destination_process)
+                raise
+
+    def receive(self, max_length):
+        deadline = time.monotonic() + self.timeout
+        while not self.frames:
+            delay = max(deadline - time.monotonic(), 0) if self.blocking else 0
+            events = self.selector.select(delay)
+            if not events:
+                if self.blocking:
+                    raise socket.timeout
+                raise BlockingIOError
+            for key, _ in events:
+                if key.fileobj is self.server:
+                    self.accept()
+                else:
+                    self.read(key.fileobj)
+        return self.frames.popleft()
+
+    def accept(self):
+        try:
+            connection, _ = self.server.accept()
+        except OSError:
+            # Nobody is waiting anymore, or the server was shut down.
+            return
+        connection.setblocking(False)
+        self.buffers[connection] = bytearray()
+        self.selector.register(connection, selectors.EVENT_READ)
+
+    def read(self, connection):
+        try:
+            data = connection.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.selector.unregister(connection)
+            del self.buffers[connection]
+            connection.close()
+            return
+
+        buffer = self.buffers[connection]
+        buffer += data
+        header_size = self.FRAME_HEADER.size
+        while len(buffer) >= header_size:
+            source_number, length = self.FRAME_HEADER.unpack_from(buffer)
+            if len(buffer) < header_size + length:
+                break
+            self.frames.append(
+                (bytes(buffer[header_size : header_size + length]), source_number)
+            )
+            del buffer[: header_size + length]
+
+
+class Ring:
+    """This class implements a single-producer/single-consumer ring buffer.
+
+    The ring lives in a file mapped in memory, under /dev/shm when available
+    such that it never reaches a disk, and may thus be shared by a producer
+    and a consumer in different processes. The file is created atomically by
+    whichever opens it first and removed by the consumer. It starts with the
+    positions of the producer and the consumer, the total number of bytes
+    each has written or read so far, followed by the buffer itself. Each
+    datagram is stored as its length followed by its bytes, padded to a
+    multiple of 4 bytes, wrapping around the end of the buffer.
+
+    Only the producer moves the head and only the consumer moves the tail,
+    such that no lock is needed.
+
+    """
+
+    POSITION = struct.Struct("Q")
+    POSITIONS = struct.Struct("QQ")
+    LENGTH = struct.Struct("I")
+    HEADER_SIZE = POSITIONS.size
+
+    DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+    def get_path(name):
+        return os.path.join(Ring.DIRECTORY, name)
+
+    def __init__(self, name, capacity):
+        self.path = Ring.get_path(name)
+        if not os.path.exists(self.path):
+            self.create(self.HEADER_SIZE + capacity)
+        with open(self.path, "r+b") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0)
+        self.capacity = len(self.buffer) - self.HEADER_SIZE
+
+    def create(self, size):
+        """Creates the ring's file, unless another process just did."""
+        fd, temporary_path = tempfile.mkstemp(dir=self.DIRECTORY)
+        try:
+            os.ftruncate(fd, size)
+            os.link(temporary_path, self.path)
+        except FileExistsError:
+            pass
+        finally:
+            os.close(fd)
+            os.unlink(temporary_path)
+
+    def close(self):
+        self.buffer.close()
+
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def copy_in(self, offset, data):
+        start = self.HEADER_SIZE + offset
+        first = self.capacity - offset
+        if len(data) <= first:
+            self.buffer[start : start + len(data)] = data
+        else:
+            self.buffer[start : start + first] = data[:first]
+            rest = len(data) - first
+            self.buffer[self.HEADER_SIZE : self.HEADER_SIZE + rest] = data[first:]
+
+    def copy_out(self, offset, length):
+        start = self.HEADER_SIZE + offset
+        first = self.capacity - offset
+        if length <= first:
+            return self.buffer[start : start + length]
+        rest = length - first
+        return (
+            self.buffer[start : start + first]
+            + self.buffer[self.HEADER_SIZE : self.HEADER_SIZE + rest]
+        )
+
+    def push(self, data):
+        """Appends a datagram to the ring.
+
+        Returns whether the consumer may have found the ring empty without
+        this datagram, once it is published, in which case the consumer must
+        be woken up. Raises BlockingIOError if the ring is full.
+
+        """
+        head, tail = self.POSITIONS.unpack_from(self.buffer)
+        # Records are aligned on their length such that it never wraps.
+        padding = -len(data) % self.LENGTH.size
+        record = self.LENGTH.pack(len(data)) + data + bytes(padding)
+        if len(record) > self.capacity - (head - tail):
+            raise BlockingIOError
+        self.copy_in(head % self.capacity, record)
+        # The datagram is published once the head moves past it.
+        self.POSITION.pack_into(self.buffer, 0, head + len(record))
+        # Reading the tail before publishing would miss a consumer draining
+        # the ring meanwhile, which then waits on its doorbell.
+        (tail,) = self.POSITION.unpack_from(self.buffer, self.POSITION.size)
+        return tail == head
+
+    def is_empty(self):
+        head, tail = self.POSITIONS.unpack_from(self.buffer)
+        return head == tail
+
+    def pop(self):
+        """Removes the next datagram from the ring, None if it is empty."""
+        head, tail = self.POSITIONS.unpack_from(self.buffer)
+        if head == tail:
+            return None
+        offset = tail % self.capacity
+        (length,) = self.LENGTH.unpack_from(self.buffer, self.HEADER_SIZE + offset)
+        offset = (offset + self.LENGTH.size) % self.capacity
+        data = self.copy_out(offset, length)
+        size = self.LENGTH.size + length + -length % self.LENGTH.size
+        self.POSITION.pack_into(self.buffer, self.POSITION.size, tail + size)
+        return data
+
+
+class SharedMemoryTransport(Transport):
+    """This class implements a transport over shared memory ring buffers.
+
+    Each ordered pair of processes shares a single-producer/single-consumer
+    Ring, created by whichever of the two opens it first. Every peer must
+    run on the same host. Sending a datagram is then a copy into the ring,
+    without a system call, unless the consumer must be woken up.
+
+    Each process owns a doorbell, a named pipe its producers write their
+    process number to when the consumer may have drained their ring before
+    their push. The consumer reads the rings whose number it found on its
+    doorbell until they are empty, checking each once more after dropping
+    it, such that a producer pushing into a ring the consumer is still
+    reading does not need to ring it. The doorbell is the transport's file
+    descriptor.
+
+    The peer map may map process numbers to the name prefix of their rings
+    and doorbell. A datagram for a peer whose ring is full waits up to the
+    timeout when blocking, and raises BlockingIOError otherwise. It never
+    hands back part of a datagram: one longer than the maximum length of the
+    receiver is dropped.
+
+    """
+
+    RING_SIZE = 64 * 1024
+    DOORBELL = struct.Struct("!H")
+
+    def get_prefix(self, process_number):
+        if self.peers is not None:
+            return self.peers[process_number]
+        return f"lsds{process_number}"
+
+    def get_doorbell(self, process_number):
+        return f"/tmp/{self.get_prefix(process_number)}.doorbell"
+
+    def get_ring_name(self, source_process, destination_process):
+        return f"{self.get_prefix(destination_process)}_ring{source_process}"
+
+    def get_ring(self, source_process, destination_process):
+        key = (source_process, destination_process)
+        if key not in self.rings:
+            name = self.get_ring_name(source_process, destination_process)
+            self.rings[key] = Ring(name, self.RING_SIZE)
+        return self.rings[key]
+
+    def open(self):
+        self.logger = Logging(self.process_number, "SHM")
+        self.blocking = True
+        self.rings = {}
+        self.doorbells = {}
+        self.unrung = set()
+        self.ready = deque()
+        self.buffered = b""
+
+        # Discard the datagrams left by a previous run.
+        stale_rings = Ring.get_path(self.get_ring_name("*", self.process_number))
+        for path in glob.glob(stale_rings):
+            os.unlink(path)
+
+        path = self.get_doorbell(self.process_number)
+        try:
+            os.unlink(path)
+        except OSError:
+            if os.path.exists(path):
+                raise
+        os.mkfifo(path)
+        self.doorbell = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        # Keep a writer open such that the doorbell never reads end of file.
+        self.doorbell_writer = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+
+    def close(self):
+        for (_, destination_process), ring in self.rings.items():
+            ring.close()
+            if destination_process == self.process_number:
+                ring.unlink()
+        for doorbell in self.doorbells.values():
+            os.close(doorbell)
+        os.close(self.doorbell)
+        os.close(self.doorbell_writer)
+        try:
+            os.unlink(self.get_doorbell(self.process_number))
+        except OSError:
+            pass
+
+    def setblocking(self, blocking):
+        self.blocking = blocking
+
+    def fileno(self):
+        return self.doorbell
+
+    def open_doorbell(self, destination_process):
+        """Opens the destination's doorbell, failing if it is not running."""
+        doorbell = self.doorbells.get(destination_process)
+        if doorbell is None:
+            doorbell = os.open(
+                self.get_doorbell(destination_process), os.O_WRONLY | os.O_NONBLOCK
+            )
+            self.doorbells[destination_process] = doorbell
+        return doorbell
+
+    def ring_doorbell(self, destination_process):
+        doorbell = self.doorbells[destination_process]
+        try:
+            os.write(doorbell, self.DOORBELL.pack(self.process_number))
+        except BlockingIOError:
+            # The doorbell is full of pending rings already.
+            pass
+        except OSError:
+            # Ring again on the next datagram, the ring is not empty anymore.
+            self.unrung.add(destination_process)
+            del self.doorbells[destination_process]
+            os.close(doorbell)
+            raise
+        self.unrung.discard(destination_process)
+
+    def sendto(self, data, destination_process):
+        self.open_doorbell(destination_process)
+        ring = self.get_ring(self.process_number, destination_process)
+        deadline = None
+        while True:
+            try:
+                drained = ring.push(data)
+                break
+            except BlockingIOError:
+                if deadline is None:
+                    deadline = time.monotonic() + self.timeout
+                if not self.blocking or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.001)
+        if drained or destination_process in self.unrung:
+            self.ring_doorbell(destination_process)
+
+    def read_doorbell(self):
+        try:
+            data = self.buffered + os.read(self.doorbell, 4096)
+        except BlockingIOError:
+            return
+        size = self.DOORBELL.size
+        end = len(data) - len(data) % size
+        self.buffered = data[end:]
+        for (source_process,) in self.DOORBELL.iter_unpack(data[:end]):
+            if source_process not in self.ready:
+                self.ready.append(source_process)
+
+    def receive(self, max_length):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            self.read_doorbell()
+            while self.ready:
+                source_process = self.ready[0]
+                ring = self.get_ring(source_process, self.process_number)
+                data = ring.pop()
+                if data is not None:
+                    # Serve the peers round robin.
+                    self.ready.rotate(-1)
+                    if len(data) > max_length:
+                        self.logger.log_debug(
+                            f"Datagram of {len(data)} bytes from {source_process} "
+                            f"dropped, longer than {max_length} bytes"
+                        )
+                        continue
+                    return data, source_process
+                self.ready.popleft()
+                # A datagram may have been pushed since, without ringing.
+                if not ring.is_empty():
+                    self.ready.append(source_process)
+            if not self.blocking:
+                raise BlockingIOError
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                raise socket.timeout
+            select.select([self.doorbell], [], [], delay)
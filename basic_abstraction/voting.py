@@ -1,11 +1,15 @@
-from threading import Event
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, TimeoutError
+from threading import Condition, Event, Semaphore
 
 from basic_abstraction.base import Abstraction
 from basic_abstraction.link import PerfectLink
 from basic_abstraction.failure_detector import PerfectFailureDetector
 from basic_abstraction.broadcast import BestEffortBroadcast, EagerReliableBroadcast
-from basic_abstraction.consensus import HierarchicalConsensus
-from basic_abstraction.leader import LeaderElection
+from basic_abstraction.broadcast import LazyReliableBroadcast
+from basic_abstraction.consensus import HierarchicalConsensus, MultiPaxosConsensus
+from basic_abstraction.leader import LeaderElection, LeaseLeaderElection
 
 from utils import Logging
 
@@ -15,54 +19,163 @@ class MajorityVoting(Abstraction):
 
     Uses:
         - PerfectFailureDetector
-        - EagerReliableBroadcast
-        - HierchicalConsensus
+        - EagerReliableBroadcast (or LazyReliableBroadcast)
+        - HierchicalConsensus (or MultiPaxosConsensus)
 
     Since this is the top-level class, it instantiates all the classes it
     requires (and their requirements). It is also not meant to be used by an
     abstraction (but still can), but by, say, a flight computer object. This
     class is callable, and its entrypoint is its __call__ method.
 
+    Votes are reliably broadcast with an EagerReliableBroadcast, or with a
+    LazyReliableBroadcast if LAZY_BROADCAST is set. Votes and elections are
+    agreed on with a HierarchicalConsensus, or with a MultiPaxosConsensus if
+    LEADER_CONSENSUS is set. If LEASE_LEADERSHIP is set, leaders are not
+    elected through consensus but hold a lease, and their successor by rank
+    takes over once it expired (see LeaseLeaderElection). The leader then
+    only opens votes and announces values while it holds its lease. The
+    MultiPaxosConsensus follows the same leader, whereas the hierarchical
+    consensus still waits for the previous leader to be detected.
+
+    Each vote is an instance identified by its leader and a sequence number.
+    The leader may have up to WINDOW votes outstanding (see vote_async), their
+    tallies being proposed to consensus in order, as many at once as the
+    consensus' window allows. If ORDERED_VOTES is set, a peer only votes on a
+    value once the leader's previous vote was delivered locally, as its vote
+    may depend on the values delivered before. Votes are then only pipelined
+    between their broadcast and their consensus.
+
+    A vote is tallied as soon as a value has the votes of a strict majority of
+    the non-detected peers, such that slow peers do not hold it back, or else
+    once every non-detected peer voted. Later votes are dropped. As a vote may
+    then be decided before its proposition was received, decisions are
+    delivered in order once their proposition is known.
+
+    The leader may also announce values, which peers deliver without voting
+    nor consensus if they accept them, and challenge otherwise (see announce).
+    Announcements are delivered after the leader's previous votes.
+
+    Besides get_leader, which waits for an ongoing election, the leader may
+    be read without blocking along with its epoch, a counter incremented on
+    each leader change (see get_leader_snapshot). Waiting for the next change
+    only takes a notification (see wait_for_leader_change).
+
+    With metrics enabled (see ./base.py), the leader counts the votes it
+    opened and their outcome, along with the votes and elections that timed
+    out, and records the time from opening a vote to its tally and to its
+    decision, such that slow votes can be told apart from slow consensus.
+
     """
 
+    EVENTS = (
+        "new_vote",
+        "vote_receive",
+        "new_announcement",
+        "acknowledge_announcement",
+    )
+    UNBATCHED_EVENTS = ("new_vote",)
+    LAZY_BROADCAST = False
+    LEADER_CONSENSUS = False
+    LEASE_LEADERSHIP = False
+    WINDOW = 4
+    ORDERED_VOTES = True
+
     def __init__(self, process_number, decide_callback, deliver_callback):
         super().__init__()
         self.process_number = process_number
         self.decide_callback = decide_callback
         self.deliver_callback = deliver_callback
 
-        self.link = PerfectLink(self.process_number)
+        self.link = self.create_link()
 
         self.pfd = PerfectFailureDetector(self.link)
         self.pfd.subscribe_abstraction(self, self.peer_failure)
 
-        self.erb = EagerReliableBroadcast(self.link)
+        self.send = self.link.register_abstraction(self)
+        self.erb = self.create_reliable_broadcast()
         self.broadcast = self.erb.register_abstraction(self)
 
         self.beb = BestEffortBroadcast(self.link)
-        self.hco = HierarchicalConsensus(self.link, self.pfd, self.beb)
+        self.hco = self.create_consensus()
         self.hco.subscribe_abstraction(self, self.consensus_decided)
 
-        self.lel_hco = HierarchicalConsensus(self.link, self.pfd, self.beb)
-        self.lel = LeaderElection(self.pfd, self.lel_hco)
+        self.lel = self.create_leader_election()
         self.lel.subscribe_abstraction(self, self.new_leader)
         self.leader = None
+        self.leader_epoch = 0
+        self.leader_condition = Condition()
 
         self.peers = {self.process_number}
         self.detected = set()
         self.erb.add_peers(self.process_number)
 
+        # Votes opened by this peer, when leader
+        self.next_instance = 0
+        self.futures = {}
+        self.queued = deque()
+        self.next_announcement = 0
+        self.opened = {}
+        self.announced = {}
+        self.announcement_slots = Semaphore(self.WINDOW)
+        self.challengers = set()
+        self.challenged = False
+
+        # Votes of every instance, identified by (leader, sequence number)
+        self.propositions = {}
         self.votes = {}
-        self.voted = {peer: False for peer in self.peers}
+        self.closed = set()
+        self.decisions = deque()
+        self.deferred = deque()
+
+        # Tallies, proposed to consensus in each leader's order
+        self.tallied = {}
+        self.released = {}
+        self.tallies = deque()
+        self.proposed = 0
+        self.decided = {}
 
         self.finished_election = Event()
-        self.finished_consensus = Event()
-        self.finished_consensus.set()
-        self.consensus_result = None
-        self.proposition = None
 
         self.logger = Logging(self.process_number, "VOT")
 
+    def _start_metrics(self):
+        super()._start_metrics()
+        labels = self.metric_labels
+        self.votes_opened = self.metrics.counter("votes_opened", **labels)
+        self.votes_accepted = self.metrics.counter("votes_accepted", **labels)
+        self.votes_rejected = self.metrics.counter("votes_rejected", **labels)
+        self.votes_failed = self.metrics.counter("votes_failed", **labels)
+        self.vote_timeouts = self.metrics.counter("vote_timeouts", **labels)
+        self.election_timeouts = self.metrics.counter("election_timeouts", **labels)
+        self.lease_waits = self.metrics.counter("lease_waits", **labels)
+        self.tally_times = self.metrics.histogram("tally_seconds", **labels)
+        self.vote_times = self.metrics.histogram("vote_seconds", **labels)
+        self._add_gauge_function(
+            "outstanding_votes", lambda: len(self.futures) + len(self.queued)
+        )
+
+    def create_link(self):
+        return PerfectLink(self.process_number)
+
+    def create_reliable_broadcast(self):
+        if self.LAZY_BROADCAST:
+            return LazyReliableBroadcast(self.link, self.pfd)
+        return EagerReliableBroadcast(self.link)
+
+    def create_consensus(self):
+        if self.LEADER_CONSENSUS:
+            return MultiPaxosConsensus(self.link, self.pfd, self.beb)
+        return HierarchicalConsensus(self.link, self.pfd, self.beb)
+
+    def create_leader_election(self):
+        if self.LEASE_LEADERSHIP:
+            self.lel_hco = None
+            lel = LeaseLeaderElection(self.link, self.pfd)
+            self.hco.follow_leader_election(lel)
+            return lel
+        self.lel_hco = self.create_consensus()
+        return LeaderElection(self.pfd, self.lel_hco)
+
     def add_peers(self, *peers):
         self.peers.update(peers)
         self.pfd.add_peers(*peers)
@@ -70,7 +183,6 @@ class MajorityVoting(Abstraction):
         self.hco.add_peers(*peers)
         self.lel.add_peers(*peers)
         self.erb.add_peers(*peers)
-        self.voted.update({peer: False for peer in self.peers})
 
     def start(self):
         super().start()
@@ -79,7 +191,8 @@ class MajorityVoting(Abstraction):
         self.erb.start()
         self.beb.start()
         self.hco.start()
-        self.lel_hco.start()
+        if self.lel_hco is not None:
+            self.lel_hco.start()
         self.lel.start()
 
     def stop(self):
@@ -89,82 +202,379 @@ class MajorityVoting(Abstraction):
         self.erb.stop()
         self.beb.stop()
         self.hco.stop()
-        self.lel_hco.stop()
+        if self.lel_hco is not None:
+            self.lel_hco.stop()
         self.lel.stop()
+        self.fail_votes()
 
     def peer_failure(self, process_number):
         self.logger.log_debug(f"Peer {process_number} crashed")
         if process_number == self.leader:
-            self.leader = None
+            self.set_leader(None)
             self.finished_election.clear()
 
         self.detected.add(process_number)
         self.erb.peers.remove(process_number)
-        self.finished_vote(process_number)
+        for instance in list(self.votes):
+            self.finished_vote(instance)
+        for announcement_id in list(self.announced):
+            self.finished_announcement(announcement_id)
 
     def new_leader(self, process_number):
         self.logger.log_debug(f"New leader {process_number}")
-        self.leader = process_number
+        self.set_leader(process_number)
         self.finished_election.set()
+        if self.leader != self.process_number:
+            self.fail_votes()
+
+    def set_leader(self, leader):
+        with self.leader_condition:
+            self.leader = leader
+            self.leader_epoch += 1
+            self.leader_condition.notify_all()
+
+    def is_decided(self, leader, sequence_number):
+        decided = self.decided.get(leader)
+        if decided is None:
+            return False
+        watermark, above_watermark = decided
+        return sequence_number < watermark or sequence_number in above_watermark
+
+    def register_decided(self, leader, sequence_number):
+        decided = self.decided.setdefault(leader, [0, set()])
+        watermark, above_watermark = decided
+        above_watermark.add(sequence_number)
+        while watermark in above_watermark:
+            above_watermark.remove(watermark)
+            watermark += 1
+        decided[0] = watermark
+
+    # Leader
+    def open_vote(self, value, future):
+        self.queued.append((value, future))
+        self.open_votes()
+
+    def open_votes(self):
+        if (
+            self.LEASE_LEADERSHIP
+            and self.queued
+            and self.leader == self.process_number
+            and not self.lel.holds_lease()
+        ):
+            # Votes wait for the lease to be renewed.
+            if self.metrics is not None:
+                self.lease_waits.increment()
+            self.trigger_later(self.lel.RENEWAL_PERIOD, self.open_votes)
+            return
+        while self.queued and len(self.futures) < self.WINDOW:
+            value, future = self.queued.popleft()
+            if self.leader != self.process_number:
+                if self.metrics is not None:
+                    self.votes_failed.increment()
+                self.resolve(future, False)
+                continue
+            sequence_number = self.next_instance
+            self.next_instance += 1
+            self.challengers.clear()
+            self.challenged = False
+            self.logger.log_debug(f"New vote {sequence_number} on: {value}")
+            self.futures[sequence_number] = future
+            if self.metrics is not None:
+                self.votes_opened.increment()
+                self.opened[sequence_number] = time.perf_counter()
+            self.broadcast(
+                self.new_vote, args=(sequence_number,), kwargs={"value": value}
+            )
 
-    def new_vote(self, source_number, value):
+    def resolve(self, future, result):
+        try:
+            future.set_result(result)
+        except InvalidStateError:
+            pass
+
+    def fail_votes(self):
+        if self.metrics is not None:
+            self.votes_failed.increment(len(self.futures) + len(self.queued))
+        for future in self.futures.values():
+            self.resolve(future, False)
+        for _, future in self.queued:
+            self.resolve(future, False)
+        self.futures.clear()
+        self.queued.clear()
+        self.opened.clear()
+        for _ in self.announced:
+            self.announcement_slots.release()
+        self.announced.clear()
+
+    # Voters
+    def new_vote(self, source_number, sequence_number, value):
+        instance = (source_number, sequence_number)
+        if self.is_decided(source_number, sequence_number):
+            # The vote was decided before its proposition was received.
+            if any(decision[0] == instance for decision in self.decisions):
+                self.propositions[instance] = value
+                self.deliver_decisions()
+            return
         if source_number != self.leader:
+            # Not voted on, but delivered if the peers that follow
+            # source_number decide it while this peer follows another leader.
+            self.propositions[instance] = value
+            return
+        if self.ORDERED_VOTES and not self.is_delivered(
+            source_number, sequence_number - 1
+        ):
+            # The previous vote has not been delivered locally yet.
+            self.deferred.append(
+                (self.new_vote, (source_number, sequence_number, value))
+            )
             return
-        self.logger.log_debug(f"Received new vote request {value} from {source_number}")
-        self.finished_consensus.clear()
-        self.proposition = value
+        self.logger.log_debug(
+            f"Received new vote request {value} from {source_number}"
+        )
+        self.propositions[instance] = value
         vote = self.decide_callback(value)
-        self.broadcast(self.vote_receive, kwargs={"vote": vote})
+        self.broadcast(self.vote_receive, args=instance, kwargs={"vote": vote})
 
-    def vote_receive(self, source_number, vote):
+    def vote_receive(self, source_number, leader, sequence_number, vote):
         self.logger.log_debug(f"Received vote {vote} from {source_number}")
-        if vote in self.votes:
-            self.votes[vote] += 1
-        else:
-            self.votes[vote] = 1
-        self.finished_vote(source_number)
-
-    def finished_vote(self, process_number):
-        self.voted[process_number] = True
-        if all(self.voted.values()):
-            self.logger.log_debug(f"Voting finished: {self.votes}")
-            max_vote = max(self.votes, key=self.votes.get)
-            self.votes.clear()
-            self.voted = {peer: False for peer in self.peers - self.detected}
-            self.hco.trigger_event(self.hco.propose, kwargs={"value": max_vote})
+        instance = (leader, sequence_number)
+        if self.is_decided(leader, sequence_number) or instance in self.closed:
+            # Late vote, the instance was already tallied
+            return
+        self.votes.setdefault(instance, {})[source_number] = vote
+        self.finished_vote(instance)
+
+    def finished_vote(self, instance):
+        votes = self.votes[instance]
+        alive = self.peers - self.detected
+        counts = {}
+        for source_number, vote in votes.items():
+            if source_number in alive:
+                counts[vote] = counts.get(vote, 0) + 1
+        # A strict majority of the non-detected peers cannot be overturned.
+        if not counts or 2 * max(counts.values()) <= len(alive):
+            if not alive <= votes.keys():
+                return
+            counts = {}
+            for vote in votes.values():
+                counts[vote] = counts.get(vote, 0) + 1
+
+        del self.votes[instance]
+        self.closed.add(instance)
+        self.logger.log_debug(f"Voting {instance} finished: {counts}")
+        if self.metrics is not None and instance[0] == self.process_number:
+            opened = self.opened.get(instance[1])
+            if opened is not None:
+                self.tally_times.observe(time.perf_counter() - opened)
+        self.tallied[instance] = max(counts, key=counts.get)
+        self.release_tallies()
+
+    def release_tallies(self):
+        for leader, sequence_number in sorted(self.tallied):
+            released = self.released.get(leader, 0)
+            while released < sequence_number and self.is_decided(leader, released):
+                released += 1
+            self.released[leader] = released
+            if sequence_number == released:
+                result = self.tallied.pop((leader, sequence_number))
+                self.tallies.append((leader, sequence_number, result))
+                self.released[leader] += 1
+        self.propose_tallies()
+
+    def propose_tallies(self):
+        # Tallies up to the consensus' window are being proposed.
+        while self.proposed < min(self.hco.WINDOW, len(self.tallies)):
+            tally = self.tallies[self.proposed]
+            self.proposed += 1
+            self.hco.trigger_event(self.hco.propose, kwargs={"value": tally})
 
     def consensus_decided(self, value):
         self.logger.log_debug(f"Consensus decided on {value}")
-        self.consensus_result = value
-        if self.consensus_result:
-            self.deliver_callback(self.proposition)
-        self.finished_consensus.set()
+        leader, sequence_number, result = value
+        instance = (leader, sequence_number)
+        # Each decision ends one of the consensus instances proposed to.
+        self.proposed = max(self.proposed - 1, 0)
+        for tally in self.tallies:
+            if tally[:2] == instance:
+                self.tallies.remove(tally)
+                break
+
+        if not self.is_decided(leader, sequence_number):
+            self.register_decided(leader, sequence_number)
+            self.votes.pop(instance, None)
+            self.closed.discard(instance)
+            self.tallied.pop(instance, None)
+            self.decisions.append((instance, result))
+            self.deliver_decisions()
+        self.release_tallies()
+
+    def is_delivered(self, leader, sequence_number):
+        if sequence_number < 0:
+            return True
+        return self.is_decided(leader, sequence_number) and not any(
+            decision[0] == (leader, sequence_number) for decision in self.decisions
+        )
+
+    def deliver_decisions(self):
+        """Delivers the decided votes in order, once their proposition is known."""
+        while self.decisions:
+            instance, result = self.decisions[0]
+            if result and instance not in self.propositions:
+                break
+            self.decisions.popleft()
+            proposition = self.propositions.pop(instance, None)
+            if result:
+                self.deliver_callback(proposition)
+            leader, sequence_number = instance
+            if leader == self.process_number:
+                future = self.futures.pop(sequence_number, None)
+                opened = self.opened.pop(sequence_number, None)
+                if future is not None:
+                    if self.metrics is not None:
+                        self.count_decided(result, opened)
+                    self.resolve(future, result)
+                self.open_votes()
+
+        while self.deferred:
+            event, args = self.deferred[0]
+            if not self.is_delivered(args[0], args[1] - 1):
+                break
+            self.deferred.popleft()
+            event(*args)
+
+    def count_decided(self, result, opened):
+        if result:
+            self.votes_accepted.increment()
+        else:
+            self.votes_rejected.increment()
+        if opened is not None:
+            self.vote_times.observe(time.perf_counter() - opened)
+
+    # Announcements
+    def open_announcement(self, value):
+        announcement_id = self.next_announcement
+        self.next_announcement += 1
+        self.announced[announcement_id] = set()
+        self.broadcast(
+            self.new_announcement,
+            args=(self.next_instance, announcement_id),
+            kwargs={"value": value},
+        )
+
+    def new_announcement(self, source_number, sequence_number, announcement_id, value):
+        if source_number != self.leader:
+            return
+        if not self.is_delivered(source_number, sequence_number - 1):
+            # Announcements follow the leader's previous vote.
+            self.deferred.append(
+                (
+                    self.new_announcement,
+                    (source_number, sequence_number, announcement_id, value),
+                )
+            )
+            return
+        accepted = self.decide_callback(value)
+        if accepted:
+            self.deliver_callback(value)
+        else:
+            self.logger.log_debug(f"Challenging {value} from {source_number}")
+        self.send(
+            source_number,
+            self.acknowledge_announcement,
+            args=(sequence_number, announcement_id, bool(accepted)),
+        )
+
+    def acknowledge_announcement(
+        self, source_number, sequence_number, announcement_id, accepted
+    ):
+        # Challenges of announcements made before the last vote are stale.
+        if not accepted and sequence_number == self.next_instance:
+            self.logger.log_debug(f"Challenged by {source_number}")
+            self.challengers.add(source_number)
+            alive = self.peers - self.detected
+            self.challenged = 2 * len(self.challengers & alive) >= len(alive)
+        if announcement_id in self.announced:
+            self.announced[announcement_id].add(source_number)
+            self.finished_announcement(announcement_id)
+
+    def finished_announcement(self, announcement_id):
+        alive = self.peers - self.detected
+        if 2 * len(self.announced[announcement_id] & alive) > len(alive):
+            del self.announced[announcement_id]
+            self.announcement_slots.release()
 
     # Entrypoints
-    def vote(self, value):
-        # Waiting for election
-        if not self.finished_election.wait(self.TIMEOUT / 3):
-            return False
-        if self.leader != self.process_number or not self.alive:
-            return False
+    def vote_async(self, value):
+        """Opens a vote on value, returns a Future of its result.
 
-        self.logger.log_debug(f"New vote on: {value}")
+        Up to WINDOW votes may be outstanding, further votes are queued until
+        earlier ones are decided. The future is resolved with False if this
+        peer is not the leader, or stops being it.
 
-        # Waiting last consensus
-        if not self.finished_consensus.wait(self.TIMEOUT / 3):
+        """
+        future = Future()
+        if self.leader != self.process_number or not self.alive:
+            if self.metrics is not None:
+                self.votes_failed.increment()
+            future.set_result(False)
+        else:
+            self.trigger_event(self.open_vote, args=(value, future))
+        return future
+
+    def announce(self, value):
+        """Has every peer deliver value without voting on it.
+
+        Peers acknowledge announcements, and those that do not accept value
+        do not deliver it, and challenge the leader instead. Returns False,
+        without announcing value, if this peer is not the leader, if enough
+        peers challenged its announcements since its last vote for a vote to
+        possibly turn out differently, or if WINDOW announcements are still
+        not acknowledged by a majority after TIMEOUT/3. The value should then
+        be voted on instead. With LEASE_LEADERSHIP, it also returns False if
+        this peer does not hold its lease.
+
+        """
+        if self.leader != self.process_number or not self.alive:
             return False
-        self.finished_consensus.clear()
-
-        self.broadcast(self.new_vote, kwargs={"value": value})
+        if self.challenged:
+            return False
+        if self.LEASE_LEADERSHIP and not self.lel.holds_lease():
+            return False
+        if not self.announcement_slots.acquire(timeout=self.TIMEOUT / 3):
+            return False
+        self.trigger_event(self.open_announcement, args=(value,))
+        return True
 
-        if not self.finished_consensus.wait(self.TIMEOUT / 3):
+    def vote(self, value):
+        # Waiting for election
+        if not self.finished_election.wait(self.TIMEOUT / 3):
+            if self.metrics is not None:
+                self.election_timeouts.increment()
+            return False
+        try:
+            return self.vote_async(value).result(2 * self.TIMEOUT / 3)
+        except TimeoutError:
+            if self.metrics is not None:
+                self.vote_timeouts.increment()
             return False
-        return self.consensus_result
 
     def get_leader(self):
         if self.finished_election.wait(self.TIMEOUT / 3):
             return self.leader
 
+    def get_leader_snapshot(self):
+        """Returns the leader (None during elections) and its epoch at once."""
+        with self.leader_condition:
+            return self.leader, self.leader_epoch
+
+    def wait_for_leader_change(self, epoch, timeout=None):
+        """Waits for the leader epoch to differ from epoch, returns a snapshot."""
+        with self.leader_condition:
+            self.leader_condition.wait_for(
+                lambda: self.leader_epoch != epoch, timeout
+            )
+            return self.leader, self.leader_epoch
+
 
 if __name__ == "__main__":
     import time
@@ -227,7 +637,14 @@ if __name__ == "__main__":
 
     if not leader.majority_voting.vote("increment"):
         raise Exception("A vote on 'increment' should be True")
-    
+
+    # Pipelined votes
+    futures = [leader.majority_voting.vote_async("increment") for _ in range(8)]
+    if not all(future.result(timeout=2) for future in futures):
+        raise Exception("Pipelined votes on 'increment' should be True")
+    if leader.count != 9:
+        raise Exception("Count should be 9")
+
     test0.majority_voting.stop()
     test1.majority_voting.stop()
     test2.majority_voting.stop()
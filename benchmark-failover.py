@@ -0,0 +1,135 @@
+import argparse
+import json
+import statistics
+import time
+
+from basic_abstraction import MajorityVoting
+from computer import CooperatingComputer
+
+
+# Argument parsing
+parser = argparse.ArgumentParser()
+parser.add_argument("--flight-computers", type=int, default=5, help="Number of flight computers (default: 5).")
+parser.add_argument("--crashes", type=int, default=10, help="Number of leader crashes measured, each on new flight computers (default: 10).")
+parser.add_argument("--warmup", type=int, default=5, help="Number of actions committed before the leader crashes (default: 5).")
+parser.add_argument("--leader-consensus", action="store_true", help="Agree on votes and leaders with a Multi-Paxos style consensus instead of the hierarchical one.")
+parser.add_argument("--lease-leadership", action="store_true", help="Have leaders hold a lease and their successor by rank take over without an election (implies --leader-consensus).")
+parser.add_argument("--output", type=str, default=None, help="JSON file the results are written to (default: none).")
+arguments, _ = parser.parse_known_args()
+
+if arguments.lease_leadership:
+    MajorityVoting.LEASE_LEADERSHIP = True
+    arguments.leader_consensus = True
+
+if arguments.leader_consensus:
+    MajorityVoting.LEADER_CONSENSUS = True
+
+
+def readout_state(tick):
+    # Synthetic ascent, enough for the flight computers to accept the states
+    altitude = tick * 5000.0
+    return {
+        "altitude": altitude,
+        "apoapsis": altitude * 1.2,
+        "periapsis": max(0.0, altitude - 20000) * 2,
+        "throttle": 1.0,
+        "fuel_srb": max(0.0, 3000 - tick * 400.0),
+        "fuel_s1": 100.0,
+        "fuel_s2": 100.0}
+
+
+def allocate_flight_computers():
+    state = readout_state(0)
+    flight_computers = {}
+    for key in range(arguments.flight_computers):
+        flight_computers[key] = CooperatingComputer(state, key)
+
+    for fc in flight_computers.values():
+        for peer in flight_computers.values():
+            if fc != peer:
+                fc.add_peers(peer)
+    for fc in flight_computers.values():
+        fc.start()
+
+    return flight_computers
+
+
+def select_leader(flight_computers, crashed=None):
+    # Same selection as the drivers, see without-ksp.py
+    crashed_number = None if crashed is None else crashed.process_number
+    deadline = time.time() + 1
+    while True:
+        snapshots = {fc.process_number: fc.get_leader_snapshot() for fc in flight_computers.values()}
+        counts = {number: 0 for number in snapshots}
+        for local_leader, _ in snapshots.values():
+            if local_leader is not None and local_leader != crashed_number:
+                counts[local_leader] += 1
+        actual_leader = max(counts, key=counts.get)
+        remaining = deadline - time.time()
+        if 2 * counts[actual_leader] > len(flight_computers) or remaining <= 0:
+            return flight_computers[actual_leader]
+
+        electing = [
+            (number, epoch)
+            for number, (local_leader, epoch) in snapshots.items()
+            if local_leader in (None, crashed_number) and epoch >= 0 and number != crashed_number
+        ]
+        if not electing:
+            return flight_computers[actual_leader]
+        number, epoch = electing[0]
+        flight_computers[number].wait_for_leader_change(epoch, remaining)
+
+
+def commit_action(leader, tick):
+    # Decides on the state and the action sampled on it, as the drivers do
+    if not leader.decide_on_state(readout_state(tick)):
+        return False
+    action = leader.sample_next_action()
+    return action is not None and leader.decide_on_action(action)
+
+
+def measure_failover():
+    flight_computers = allocate_flight_computers()
+    leader = select_leader(flight_computers)
+    tick = 0
+    while tick < arguments.warmup:
+        if commit_action(leader, tick):
+            tick += 1
+        else:
+            leader = select_leader(flight_computers, leader)
+
+    crashed = leader
+    start = time.perf_counter()
+    crashed.stop()
+    selections = 0
+    while True:
+        leader = select_leader(flight_computers, crashed)
+        selections += 1
+        if leader is not crashed and commit_action(leader, tick):
+            break
+    failover = time.perf_counter() - start
+
+    for fc in flight_computers.values():
+        fc.stop()
+    return failover, selections
+
+
+failovers = []
+for crash in range(arguments.crashes):
+    failover, selections = measure_failover()
+    print(f"Crash {crash}: next action committed after {1000 * failover:.1f} ms ({selections} leader selections)")
+    failovers.append(failover)
+
+results = {
+    "flight_computers": arguments.flight_computers,
+    "leader_consensus": arguments.leader_consensus,
+    "lease_leadership": arguments.lease_leadership,
+    "failover_ms": [1000 * failover for failover in failovers],
+    "median_ms": 1000 * statistics.median(failovers),
+    "mean_ms": 1000 * statistics.mean(failovers),
+    "max_ms": 1000 * max(failovers)}
+print(f"Crash to next committed action: median {results['median_ms']:.1f} ms, mean {results['mean_ms']:.1f} ms, max {results['max_ms']:.1f} ms")
+
+if arguments.output is not None:
+    with open(arguments.output, "w") as output_file:
+        json.dump(results, output_file, indent=4)
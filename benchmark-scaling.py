@@ -0,0 +1,260 @@
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import threading
+import time
+
+from basic_abstraction import Abstraction, AsyncioScheduler, PoolScheduler, PerfectLink, MajorityVoting
+from basic_abstraction import UnixTransport, UDPTransport, TCPTransport, SharedMemoryTransport
+from computer import CooperatingComputer
+from computer import faulty
+
+
+# Argument parsing
+parser = argparse.ArgumentParser()
+parser.add_argument("--flight-computers", type=int, nargs="+", default=[3, 5, 10, 20, 50], help="Numbers of flight computers benchmarked (default: 3 5 10 20 50).")
+parser.add_argument("--faulty", type=str, nargs="*", default=[], help="Faulty flight computers among them, as Class=count pairs of computer/faulty.py classes (default: none).")
+parser.add_argument("--decisions", type=int, default=200, help="Number of decide_on_state and decide_on_action calls per run (default: 200).")
+parser.add_argument("--seed", type=int, default=0, help="Seed placing the faulty flight computers (default: 0).")
+parser.add_argument("--runtime", choices=["threads", "pool", "asyncio"], default="threads", help="Runtime executing the abstractions' events (default: threads).")
+parser.add_argument("--workers", type=int, default=4, help="Number of worker threads of the pool runtime (default: 4).")
+parser.add_argument("--batch-window", type=float, default=None, help="Batch the messages sent to a same computer within this window, in milliseconds (default: no batching).")
+parser.add_argument("--transport", choices=["unix", "udp", "tcp", "shm"], default="unix", help="Transport of the links between flight computers (default: unix).")
+parser.add_argument("--loopback", action="store_true", help="Let the flight computers skip the transport, as they share this process (no datagrams are then counted).")
+parser.add_argument("--lazy-broadcast", action="store_true", help="Relay votes only once their sender is detected to have crashed.")
+parser.add_argument("--leader-consensus", action="store_true", help="Agree on votes and leaders with a Multi-Paxos style consensus instead of the hierarchical one.")
+parser.add_argument("--lease-leadership", action="store_true", help="Have leaders hold a lease and their successor by rank take over without an election (implies --leader-consensus).")
+parser.add_argument("--output", type=str, default="benchmark-scaling.json", help="JSON file the results are written to (default: benchmark-scaling.json).")
+arguments, _ = parser.parse_known_args()
+
+faulty_classes = {}
+for pair in arguments.faulty:
+    name, count = pair.split("=")
+    faulty_classes[getattr(faulty, name)] = int(count)
+
+if arguments.lazy_broadcast:
+    MajorityVoting.LAZY_BROADCAST = True
+
+if arguments.lease_leadership:
+    MajorityVoting.LEASE_LEADERSHIP = True
+    arguments.leader_consensus = True
+
+if arguments.leader_consensus:
+    MajorityVoting.LEADER_CONSENSUS = True
+
+if arguments.batch_window is not None:
+    PerfectLink.BATCH_WINDOW = arguments.batch_window / 1000
+
+PerfectLink.LOOPBACK = arguments.loopback
+
+if arguments.runtime == "pool":
+    Abstraction.set_scheduler(PoolScheduler(arguments.workers))
+elif arguments.runtime == "asyncio":
+    Abstraction.set_scheduler(AsyncioScheduler())
+
+
+class Traffic:
+    """Datagrams and bytes sent through the transports of this process."""
+
+    lock = threading.Lock()
+    datagrams = 0
+    bytes = 0
+
+    def count(length):
+        with Traffic.lock:
+            Traffic.datagrams += 1
+            Traffic.bytes += length
+
+    def read():
+        with Traffic.lock:
+            return Traffic.datagrams, Traffic.bytes
+
+
+def counting_transport(transport):
+    class CountingTransport(transport):
+        def sendto(self, data, destination_process):
+            Traffic.count(len(data))
+            return super().sendto(data, destination_process)
+
+    return CountingTransport
+
+
+def set_transport(n_fc):
+    transports = {"unix": UnixTransport, "udp": UDPTransport, "tcp": TCPTransport, "shm": SharedMemoryTransport}
+    peers = None
+    if arguments.transport in ("udp", "tcp"):
+        peers = {number: ("localhost", 9000 + number) for number in range(n_fc)}
+    PerfectLink.set_transport(counting_transport(transports[arguments.transport]), peers)
+
+
+def readout_state(tick):
+    # Synthetic climb, held below the first stage's altitude such that the
+    # flight computers accept any number of states and actions.
+    return {
+        "altitude": (tick % 1000) * 0.5,
+        "apoapsis": (tick % 1000) * 0.6,
+        "periapsis": 0.0,
+        "throttle": 1.0,
+        "fuel_srb": 3000.0,
+        "fuel_s1": 100.0,
+        "fuel_s2": 100.0}
+
+
+def allocate_flight_computers(n_fc):
+    state = readout_state(0)
+    allocations = [kls for kls, count in faulty_classes.items() for _ in range(count)]
+    allocations += [CooperatingComputer] * (n_fc - len(allocations))
+    random.Random(arguments.seed).shuffle(allocations)
+
+    flight_computers = {}
+    for key, allocate in enumerate(allocations):
+        flight_computers[key] = allocate(state, key)
+
+    for fc in flight_computers.values():
+        for peer in flight_computers.values():
+            if fc != peer:
+                fc.add_peers(peer)
+    start = time.perf_counter()
+    for fc in flight_computers.values():
+        fc.start()
+    startup = time.perf_counter() - start
+
+    return flight_computers, {key: type(fc).__name__ for key, fc in flight_computers.items()}, startup
+
+
+def select_leader(flight_computers, crashed=None):
+    # Same selection as the drivers, see without-ksp.py
+    crashed_number = None if crashed is None else crashed.process_number
+    deadline = time.time() + 1
+    while True:
+        snapshots = {fc.process_number: fc.get_leader_snapshot() for fc in flight_computers.values()}
+        counts = {number: 0 for number in snapshots}
+        for local_leader, _ in snapshots.values():
+            if local_leader is not None and local_leader != crashed_number:
+                counts[local_leader] += 1
+        actual_leader = max(counts, key=counts.get)
+        remaining = deadline - time.time()
+        if 2 * counts[actual_leader] > len(flight_computers) or remaining <= 0:
+            return flight_computers[actual_leader]
+
+        electing = [
+            (number, epoch)
+            for number, (local_leader, epoch) in snapshots.items()
+            if local_leader in (None, crashed_number) and epoch >= 0 and number != crashed_number
+        ]
+        if not electing:
+            return flight_computers[actual_leader]
+        number, epoch = electing[0]
+        flight_computers[number].wait_for_leader_change(epoch, remaining)
+
+
+def percentile(latencies, percent):
+    if len(latencies) < 2:
+        return latencies[0] if latencies else None
+    return statistics.quantiles(latencies, n=100)[percent - 1]
+
+
+def benchmark(n_fc):
+    set_transport(n_fc)
+    flight_computers, allocation, startup = allocate_flight_computers(n_fc)
+    leader = select_leader(flight_computers)
+
+    latencies = []
+    decided = 0
+    stopped = set()
+    max_threads = threading.active_count()
+    datagrams, n_bytes = Traffic.read()
+    cpu = time.process_time()
+    start = time.perf_counter()
+
+    def timed_decision(decide, *args):
+        decision_start = time.perf_counter()
+        decision = decide(*args)
+        latencies.append(time.perf_counter() - decision_start)
+        return decision
+
+    tick = 0
+    while len(latencies) < arguments.decisions and 2 * len(stopped) < n_fc:
+        failed = not timed_decision(leader.decide_on_state, readout_state(tick))
+        if not failed:
+            decided += 1
+            action = leader.sample_next_action()
+            failed = action is None or not timed_decision(leader.decide_on_action, action)
+        if failed:
+            # As the drivers do, a leader that failed a decision is stopped
+            leader.stop()
+            stopped.add(leader.process_number)
+            leader = select_leader(flight_computers, leader)
+        else:
+            decided += 1
+            tick += 1
+        max_threads = max(max_threads, threading.active_count())
+
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    datagrams, n_bytes = (total - initial for total, initial in zip(Traffic.read(), (datagrams, n_bytes)))
+
+    # Peers detected though not stopped, e.g. as they started too late
+    running = [fc for fc in flight_computers.values() if fc.process_number not in stopped]
+    false_detections = sum(len(fc.majority_voting.detected - stopped) for fc in running) / len(running)
+
+    for fc in flight_computers.values():
+        fc.stop()
+
+    calls = len(latencies)
+    return {
+        "flight_computers": n_fc,
+        "allocation": allocation,
+        "startup_s": startup,
+        "calls": calls,
+        "decisions": decided,
+        "stopped_leaders": len(stopped),
+        "completed": calls >= arguments.decisions,
+        "elapsed_s": elapsed,
+        "decisions_per_s": decided / elapsed,
+        "latency_p50_ms": 1000 * percentile(latencies, 50),
+        "latency_p95_ms": 1000 * percentile(latencies, 95),
+        "latency_p99_ms": 1000 * percentile(latencies, 99),
+        "datagrams_per_decision": datagrams / max(decided, 1),
+        "bytes_per_decision": n_bytes / max(decided, 1),
+        "cpu_s": cpu,
+        "cpu_per_decision_ms": 1000 * cpu / max(decided, 1),
+        "max_threads": max_threads,
+        "false_detections": false_detections}
+
+
+def wait_for_threads(count, timeout):
+    # The links of stopped flight computers wait for their socket's timeout
+    deadline = time.time() + timeout
+    while threading.active_count() > count and time.time() < deadline:
+        time.sleep(0.05)
+
+
+try:
+    commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+except OSError:
+    commit = None
+
+report = {
+    "commit": commit,
+    "python": platform.python_version(),
+    "arguments": vars(arguments),
+    "runs": []}
+
+initial_threads = threading.active_count()
+for n_fc in arguments.flight_computers:
+    result = benchmark(n_fc)
+    report["runs"].append(result)
+    print(
+        f"{n_fc} flight computers: {result['decisions_per_s']:.1f} decisions/s, "
+        f"latency p50 {result['latency_p50_ms']:.1f} ms, p95 {result['latency_p95_ms']:.1f} ms, p99 {result['latency_p99_ms']:.1f} ms, "
+        f"{result['datagrams_per_decision']:.1f} datagrams and {result['bytes_per_decision']:.0f} bytes per decision, "
+        f"{result['cpu_per_decision_ms']:.1f} ms CPU per decision, {result['max_threads']} threads, "
+        f"{result['false_detections']:.1f} peers falsely detected per computer"
+        + ("" if result["completed"] else " (stopped early, failed leaders stopped a majority of the computers)"))
+    with open(arguments.output, "w") as output_file:
+        json.dump(report, output_file, indent=4)
+    wait_for_threads(initial_threads, 2 * Abstraction.TIMEOUT)
@@ -1,2 +1,3 @@
 from computer.cooperating import CooperatingComputer
 from computer.faulty import allocate_faulty_flight_computer
+from computer.process import FlightComputerFailed, FlightComputerProcess
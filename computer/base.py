@@ -31,9 +31,22 @@ class FlightComputer:
         self.deliver_action(action)
         return decided
 
+    def decide_on_step(self, state, action):
+        decided = self.acceptable_step(state, action)
+        self.deliver_step(state, action)
+        return decided
+
     def sample_next_action(self):
         return self.stage_handler()
 
+    def sample_next_action_on(self, state):
+        # Sample the action following state, without delivering state
+        previous_state, self.state = self.state, state
+        try:
+            return self.sample_next_action()
+        finally:
+            self.state = previous_state
+
     def acceptable_state(self, state):
         return True
 
@@ -49,6 +62,19 @@ class FlightComputer:
 
         return True
 
+    def acceptable_step(self, state, action):
+        if not self.acceptable_state(state):
+            return False
+        previous_state, self.state = self.state, state
+        try:
+            return self.acceptable_action(action)
+        finally:
+            self.state = previous_state
+
+    def deliver_step(self, state, action):
+        self.deliver_state(state)
+        self.deliver_action(action)
+
     def deliver_action(self, action):
         if "next_stage" in action and action["next_stage"]:
             self.current_stage_index += 1
@@ -10,15 +10,31 @@ class CooperatingComputer(FlightComputer):
     """This class implements a cooperating flight computer.
 
     This class uses a majority voting algorithm to cooperate with its
-    colleagues.
+    colleagues. A state and the action sampled on it may be decided at once
+    with decide_on_step, in a single vote delivering both. Decisions may be
+    pipelined through the asynchronous decide_on_*_async methods, returning
+    futures of the decisions.
+
+    If CHANGE_DRIVEN is set, steps whose action is the last committed one,
+    and does not request a stage transition, are announced by the leader
+    instead of voted on (see MajorityVoting.announce). Followers deliver them
+    if their own action on the state is the same, and challenge the leader
+    otherwise. Votes are then only run on action changes, or once challenges
+    could turn a vote over.
 
     """
 
+    CHANGE_DRIVEN = False
+
     def __init__(self, state, process_number):
         super().__init__(state)
         self.process_number = process_number
-        self.majority_voting = MajorityVoting(
-            process_number, self.acceptable_value, self.deliver_value
+        self.majority_voting = self.create_majority_voting()
+        self.committed_action = None
+
+    def create_majority_voting(self):
+        return MajorityVoting(
+            self.process_number, self.acceptable_value, self.deliver_value
         )
 
     def add_peers(self, *peers):
@@ -43,12 +59,43 @@ class CooperatingComputer(FlightComputer):
         value = ("action", action)
         return self.decide_on_value(value)
 
+    def decide_on_step(self, state, action):
+        value = ("step", (state, action))
+        if self.CHANGE_DRIVEN and self.unchanged_action(action):
+            if self.majority_voting.announce(value):
+                return True
+        return self.decide_on_value(value)
+
+    def unchanged_action(self, action):
+        return (
+            action == self.committed_action
+            and not action.get("stage")
+            and not action.get("next_stage")
+        )
+
+    def decide_on_value_async(self, value):
+        return self.majority_voting.vote_async(value)
+
+    def decide_on_state_async(self, state):
+        value = ("state", state)
+        return self.decide_on_value_async(value)
+
+    def decide_on_action_async(self, action):
+        value = ("action", action)
+        return self.decide_on_value_async(value)
+
+    def decide_on_step_async(self, state, action):
+        value = ("step", (state, action))
+        return self.decide_on_value_async(value)
+
     def acceptable_value(self, value):
         proposition_type, actual_value = value
         if proposition_type == "state":
             return self.acceptable_state(actual_value)
         elif proposition_type == "action":
             return self.acceptable_action(actual_value)
+        elif proposition_type == "step":
+            return self.acceptable_step(*actual_value)
 
     def deliver_value(self, value):
         proposition_type, actual_value = value
@@ -56,6 +103,16 @@ class CooperatingComputer(FlightComputer):
             self.deliver_state(actual_value)
         elif proposition_type == "action":
             self.deliver_action(actual_value)
+            self.committed_action = actual_value
+        elif proposition_type == "step":
+            self.deliver_step(*actual_value)
+            self.committed_action = actual_value[1]
 
     def get_leader(self):
         return self.majority_voting.get_leader()
+
+    def get_leader_snapshot(self):
+        return self.majority_voting.get_leader_snapshot()
+
+    def wait_for_leader_change(self, epoch, timeout=None):
+        return self.majority_voting.wait_for_leader_change(epoch, timeout)
@@ -1,12 +1,10 @@
+import asyncio
 import random
 import time
 
 from basic_abstraction import Abstraction
 from basic_abstraction import PerfectLink
-from basic_abstraction import PerfectFailureDetector
-from basic_abstraction import BestEffortBroadcast, EagerReliableBroadcast
-from basic_abstraction import LeaderElection
-from basic_abstraction import HierarchicalConsensus
+from basic_abstraction import MajorityVoting
 
 from .cooperating import CooperatingComputer
 
@@ -39,30 +37,37 @@ class SlowFlightComputer(CooperatingComputer):
     """ This class implements a slow flight computer.
 
     To simulate a slow flight computer, we simply made the computer's link
-    abstraction sleep before sending data.
+    abstraction sleep before sending data. On an event loop, the link awaits
+    instead so that the other computers of the process are not slowed down.
+    The slow link is created by the majority voting in place of the regular
+    one, such that a single socket is bound to the computer's address.
 
     """
     class SlowPerfectLink(PerfectLink):
         def send(self, *args, **kwargs):
-            time.sleep(random.uniform(1, 10))  # Seconds
+            delay = random.uniform(1, 10)  # Seconds
+            if self.scheduler.loop is not None:
+                return self.send_after(delay, *args, **kwargs)
+            time.sleep(delay)
             super().send(*args, **kwargs)
 
+        async def send_after(self, delay, *args, **kwargs):
+            await asyncio.sleep(delay)
+            result = super().send(*args, **kwargs)
+            if result is not None:
+                await result
+
+    class SlowMajorityVoting(MajorityVoting):
+        def create_link(self):
+            return SlowFlightComputer.SlowPerfectLink(self.process_number)
+
     def __init__(self, state, process_number):
         super(SlowFlightComputer, self).__init__(state, process_number)
-        mv = self.majority_voting
-        mv.link = SlowFlightComputer.SlowPerfectLink(mv.process_number)
-        mv.pfd = PerfectFailureDetector(mv.link)
-        mv.pfd.subscribe_abstraction(mv, mv.peer_failure)
-        mv.erb = EagerReliableBroadcast(mv.link)
-        mv.broadcast = mv.erb.register_abstraction(mv)
-        mv.beb = BestEffortBroadcast(mv.link)
-        mv.hco = HierarchicalConsensus(mv.link, mv.pfd, mv.beb)
-        mv.hco.subscribe_abstraction(mv, mv.consensus_decided)
-        mv.peers = {mv.process_number}
-        mv.erb.add_peers(mv.process_number)
-        mv.lel_hco = HierarchicalConsensus(mv.link, mv.pfd, mv.beb)
-        mv.lel = LeaderElection(mv.pfd, mv.lel_hco)
-        mv.lel.subscribe_abstraction(mv, mv.new_leader)
+
+    def create_majority_voting(self):
+        return SlowFlightComputer.SlowMajorityVoting(
+            self.process_number, self.acceptable_value, self.deliver_value
+        )
 
 
 class CrashingFlightComputer(CooperatingComputer):
@@ -0,0 +1,154 @@
+import multiprocessing
+import random
+import sys
+import threading
+import traceback
+from collections import namedtuple
+
+
+Peer = namedtuple("Peer", ["process_number"])
+
+# Default of FlightComputerProcess.call, for calls that raise on failed computers
+NO_DEFAULT = object()
+
+
+class FlightComputerFailed(Exception):
+    pass
+
+
+def serve(connection, allocate, state, process_number, setup=None):
+    """Runs a flight computer, calling its methods on request.
+
+    The requests are (method, args) pairs received on the connection, each
+    answered by a ("result", value) or ("error", traceback) pair.
+
+    """
+    # Forked processes share their parent's random state
+    random.seed()
+    if setup is not None:
+        setup()
+    computer = allocate(state, process_number)
+
+    while True:
+        try:
+            method, args = connection.recv()
+        except EOFError:
+            computer.stop()
+            break
+        try:
+            reply = ("result", getattr(computer, method)(*args))
+        except Exception:
+            reply = ("error", traceback.format_exc())
+        connection.send(reply)
+        if method == "stop":
+            break
+    connection.close()
+
+
+class FlightComputerProcess:
+    """This class implements a proxy to a flight computer in its own process.
+
+    The flight computer is allocated by calling allocate(state,
+    process_number) in a forked process, after calling setup if given. The
+    setup function must configure everything that runs threads, such as the
+    Abstraction scheduler, as forked processes only inherit the thread that
+    forked them. Class attributes set beforehand, such as the PerfectLink
+    transport, are inherited.
+
+    Computers in distinct processes do not share an interpreter, so that a
+    busy computer does not stall the others' abstractions, and a crash is
+    confined to its own process. Calls are serialized, as replies come back
+    on a single pipe.
+
+    A stopped computer answers what a crashed computer would: no leader (with
+    an epoch of -1), and no decision. A process that is gone without being
+    stopped marks the computer failed, which is reported once, and answers as
+    a stopped computer afterwards. Calls without such an answer, such as
+    start, raise FlightComputerFailed instead.
+
+    """
+
+    def __init__(self, allocate, state, process_number, setup=None):
+        self.process_number = process_number
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.failed = False
+        context = multiprocessing.get_context("fork")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=serve,
+            args=(child_connection, allocate, state, process_number, setup),
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+
+    def call(self, method, *args, default=NO_DEFAULT):
+        with self.lock:
+            if not self.stopped and not self.failed:
+                try:
+                    self.connection.send((method, args))
+                    status, result = self.connection.recv()
+                except (EOFError, OSError):
+                    self.set_failed(method)
+                else:
+                    if status == "error":
+                        raise Exception(
+                            f"Flight computer {self.process_number} failed on "
+                            f"{method}:\n{result}"
+                        )
+                    return result
+        if default is NO_DEFAULT:
+            raise FlightComputerFailed(
+                f"Flight computer {self.process_number} is gone, cannot {method}"
+            )
+        return default
+
+    def set_failed(self, method):
+        self.failed = True
+        self.process.join(timeout=1)
+        print(
+            f"Flight computer {self.process_number} failed on {method}: its "
+            f"process is gone (exit code {self.process.exitcode})",
+            file=sys.stderr,
+        )
+
+    def add_peers(self, *peers):
+        peers = [Peer(peer.process_number) for peer in peers]
+        self.call("add_peers", *peers)
+
+    def start(self):
+        self.call("start")
+
+    def stop(self):
+        self.call("stop", default=None)
+        with self.lock:
+            self.stopped = True
+            self.connection.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def get_leader(self):
+        return self.call("get_leader", default=None)
+
+    def get_leader_snapshot(self):
+        return self.call("get_leader_snapshot", default=(None, -1))
+
+    def wait_for_leader_change(self, epoch, timeout=None):
+        return self.call("wait_for_leader_change", epoch, timeout, default=(None, -1))
+
+    def decide_on_state(self, state):
+        return self.call("decide_on_state", state, default=False)
+
+    def decide_on_action(self, action):
+        return self.call("decide_on_action", action, default=False)
+
+    def decide_on_step(self, state, action):
+        return self.call("decide_on_step", state, action, default=False)
+
+    def sample_next_action(self):
+        return self.call("sample_next_action", default=False)
+
+    def sample_next_action_on(self, state):
+        return self.call("sample_next_action_on", state, default=False)
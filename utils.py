@@ -1,3 +1,7 @@
+import statistics
+from threading import Condition
+
+
 class Logging:
     debug = {}
     existing_logger = {}
@@ -30,3 +34,43 @@ class Logging:
     def log_debug(self, message):
         if self.is_debug():
             print(f"Process {self.process_number} ({self.namespace}): {message}")
+
+
+class Countdown:
+    """Counts events down from a number, which may be waited to reach zero.
+
+    Used by the microbenchmarks of the abstractions' modules to wait for
+    deliveries from their threads.
+
+    """
+
+    def __init__(self, count=0):
+        self.condition = Condition()
+        self.count = count
+
+    def reset(self, count):
+        with self.condition:
+            self.count = count
+
+    def count_down(self):
+        with self.condition:
+            self.count -= 1
+            if self.count <= 0:
+                self.condition.notify_all()
+
+    def wait(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.count <= 0, timeout)
+
+
+def report_latencies(name, latencies):
+    """Prints the median, 95th percentile and maximum of latencies in seconds."""
+    if len(latencies) > 1:
+        p95 = statistics.quantiles(latencies, n=20, method="inclusive")[-1]
+    else:
+        p95 = max(latencies)
+    print(
+        f"{name}: median {1000 * statistics.median(latencies):.2f} ms, "
+        f"p95 {1000 * p95:.2f} ms, max {1000 * max(latencies):.2f} ms "
+        f"({len(latencies)} samples)"
+    )
@@ -1,18 +1,80 @@
 import argparse
+import json
 import krpc
 import math
+import os
 import time
 import random
 
-from computer import CooperatingComputer, allocate_faulty_flight_computer
+from basic_abstraction import Abstraction, AsyncioScheduler, PoolScheduler, PerfectLink, MajorityVoting, MetricsRegistry
+from basic_abstraction import UDPTransport, TCPTransport, SharedMemoryTransport
+from computer import CooperatingComputer, FlightComputerProcess, allocate_faulty_flight_computer
 
 
 # Argument parsing
 parser = argparse.ArgumentParser()
 parser.add_argument("--correct-fraction", type=float, default=1.0, help="Fraction of correct flight computers (default 1.0).")
 parser.add_argument("--flight-computers", type=int, default=3, help="Number of flight computers (default: 3).")
+parser.add_argument("--runtime", choices=["threads", "pool", "asyncio"], default="threads", help="Runtime executing the abstractions' events (default: threads).")
+parser.add_argument("--workers", type=int, default=4, help="Number of worker threads of the pool runtime (default: 4).")
+parser.add_argument("--batch-window", type=float, default=None, help="Batch the messages sent to a same computer within this window, in milliseconds (default: no batching).")
+parser.add_argument("--transport", choices=["unix", "udp", "tcp", "shm"], default="unix", help="Transport of the links between flight computers (default: unix).")
+parser.add_argument("--lazy-broadcast", action="store_true", help="Relay votes only once their sender is detected to have crashed.")
+parser.add_argument("--leader-consensus", action="store_true", help="Agree on votes and leaders with a Multi-Paxos style consensus instead of the hierarchical one.")
+parser.add_argument("--lease-leadership", action="store_true", help="Have leaders hold a lease and their successor by rank take over without an election (implies --leader-consensus).")
+parser.add_argument("--combined-steps", action="store_true", help="Decide on each state and the action sampled on it in a single vote.")
+parser.add_argument("--change-driven", action="store_true", help="Only vote on actions that differ from the last committed one (implies --combined-steps).")
+parser.add_argument("--processes", action="store_true", help="Run each flight computer in its own process.")
+parser.add_argument("--metrics", type=str, default=None, help="JSON file the metrics of the abstractions are periodically dumped to, suffixed by the process id with --processes (default: no metrics).")
+parser.add_argument("--metrics-period", type=float, default=1.0, help="Period of the metrics dumps, in seconds (default: 1).")
+parser.add_argument("--peers", type=str, default=None, help="JSON file mapping process numbers to \"host:port\" addresses (default: localhost, from port 9000 on).")
 arguments, _ = parser.parse_known_args()
 
+if arguments.transport == "shm":
+    PerfectLink.set_transport(SharedMemoryTransport)
+elif arguments.transport != "unix":
+    if arguments.peers is not None:
+        with open(arguments.peers) as peers_file:
+            peers = {int(number): address for number, address in json.load(peers_file).items()}
+    else:
+        peers = {number: f"localhost:{9000 + number}" for number in range(arguments.flight_computers)}
+    peers = {number: (address.rsplit(":", 1)[0], int(address.rsplit(":", 1)[1])) for number, address in peers.items()}
+    transports = {"udp": UDPTransport, "tcp": TCPTransport}
+    PerfectLink.set_transport(transports[arguments.transport], peers)
+
+if arguments.lazy_broadcast:
+    MajorityVoting.LAZY_BROADCAST = True
+
+if arguments.lease_leadership:
+    MajorityVoting.LEASE_LEADERSHIP = True
+    arguments.leader_consensus = True
+
+if arguments.leader_consensus:
+    MajorityVoting.LEADER_CONSENSUS = True
+
+if arguments.change_driven:
+    CooperatingComputer.CHANGE_DRIVEN = True
+    arguments.combined_steps = True
+
+if arguments.batch_window is not None:
+    PerfectLink.BATCH_WINDOW = arguments.batch_window / 1000
+
+
+def setup_runtime():
+    if arguments.runtime == "pool":
+        Abstraction.set_scheduler(PoolScheduler(arguments.workers))
+    elif arguments.runtime == "asyncio":
+        Abstraction.set_scheduler(AsyncioScheduler())
+    if arguments.metrics is not None:
+        path = f"{arguments.metrics}.{os.getpid()}" if arguments.processes else arguments.metrics
+        Abstraction.set_metrics(MetricsRegistry())
+        Abstraction.metrics.start_dump(path, arguments.metrics_period)
+
+
+# Each flight computer process sets its own runtime up
+if not arguments.processes:
+    setup_runtime()
+
 
 connection = krpc.connect(name="INFO8002")
 vessel = connection.space_center.active_vessel
@@ -67,9 +129,13 @@ def allocate_flight_computers(arguments):
 
     for i, key in enumerate(keys):
         if i < n_correct_fc:
-            flight_computers[key] = CooperatingComputer(state, key)
+            allocate = CooperatingComputer
         else:
-            flight_computers[key] = allocate_faulty_flight_computer(state, key)
+            allocate = allocate_faulty_flight_computer
+        if arguments.processes:
+            flight_computers[key] = FlightComputerProcess(allocate, state, key, setup_runtime)
+        else:
+            flight_computers[key] = allocate(state, key)
 
     # Add the peers for the consensus protocol
     for fc in flight_computers.values():
@@ -85,14 +151,32 @@ def allocate_flight_computers(arguments):
 flight_computers = allocate_flight_computers(arguments)
 
 
-def select_leader():
-    counts = {fc.process_number: 0 for fc in flight_computers.values()}
-    for fc in flight_computers.values():
-        local_leader = fc.get_leader()
-        if local_leader is not None:
-            counts[local_leader] += 1
-    actual_leader = max(counts, key=counts.get)
-    return flight_computers[actual_leader]
+def select_leader(crashed=None):
+    # Leader snapshots do not block. While no leader is agreed on by a majority,
+    # a computer electing a leader (or still following the crashed one) is
+    # waited on until its leader changes.
+    crashed_number = None if crashed is None else crashed.process_number
+    deadline = time.time() + 1
+    while True:
+        snapshots = {fc.process_number: fc.get_leader_snapshot() for fc in flight_computers.values()}
+        counts = {number: 0 for number in snapshots}
+        for local_leader, _ in snapshots.values():
+            if local_leader is not None and local_leader != crashed_number:
+                counts[local_leader] += 1
+        actual_leader = max(counts, key=counts.get)
+        remaining = deadline - time.time()
+        if 2 * counts[actual_leader] > len(flight_computers) or remaining <= 0:
+            return flight_computers[actual_leader]
+
+        electing = [
+            (number, epoch)
+            for number, (local_leader, epoch) in snapshots.items()
+            if local_leader in (None, crashed_number) and epoch >= 0 and number != crashed_number
+        ]
+        if not electing:
+            return flight_computers[actual_leader]
+        number, epoch = electing[0]
+        flight_computers[number].wait_for_leader_change(epoch, remaining)
 
 
 def next_action(state):
@@ -129,10 +213,23 @@ complete = False
 leader = select_leader()
 while not complete:
     state = readout_state()
+    if arguments.combined_steps:
+        action = leader.sample_next_action_on(state)
+        if action is None:
+            complete = True
+        elif action is False:
+            leader = select_leader(leader)
+        elif leader.decide_on_step(state, action):
+            execute_action(action)
+        else:
+            leader.stop()
+            leader = select_leader(leader)
+        continue
+
     state_decided = leader.decide_on_state(state)
     if not state_decided:
         leader.stop()
-        leader = select_leader()
+        leader = select_leader(leader)
         continue
     action = leader.sample_next_action()
     if action is None:
@@ -143,9 +240,12 @@ while not complete:
         execute_action(action)
     else:
         leader.stop()
-        leader = select_leader()
+        leader = select_leader(leader)
 
 print("Hopefully in orbit!")
 
 for fc in flight_computers.values():
     fc.stop()
+
+if Abstraction.metrics is not None:
+    Abstraction.metrics.stop_dump()